@@ -0,0 +1,5 @@
+"""
+Package: benchmarks
+Performance benchmarks for the Inventory Service, run by hand rather than
+by the test suite. See the Benchmarks section of the README.
+"""
@@ -0,0 +1,342 @@
+"""
+HTTP Load Benchmark
+
+Seeds inventory items, drives every route of the service at a fixed
+concurrency and reports throughput and p50/p95/p99 latency per route.
+
+    python -m benchmarks.http_load --rows 10000 --concurrency 8 --requests 500
+    python -m benchmarks.http_load --save baseline.json
+    python -m benchmarks.http_load --compare baseline.json --threshold 0.2
+
+Without --url the service runs in this process on a fresh SQLite database,
+or on --database-uri (use --reset to empty it first, so only point it at a
+scratch database). With --url the running service at that address is used
+and the seed rows are added to whatever it already holds.
+
+--compare exits with status 1 when any route's p95 latency grew, or its
+throughput fell, by more than --threshold (a fraction) against the baseline.
+"""
+import argparse
+import csv
+import http.client
+import io
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+SEED_BATCH_SIZE = 1000
+ROWS_PER_SUPPLIER = 100
+# each import uploads this many items, numbered from IMPORT_BASE so they never
+# clash with the seeded ones and the filtered delete can find them again
+IMPORT_ROWS = 100
+IMPORT_BASE = 10 ** 8
+
+
+class Context():
+    """ What the scenarios need to know about the seeded data """
+
+    def __init__(self, inventory_ids, delete_ids, suppliers):
+        self.inventory_ids = inventory_ids
+        self.delete_ids = delete_ids
+        self.suppliers = suppliers
+
+    def inventory_id(self, n):
+        """ Returns a seeded inventory id, spread over the table """
+        return self.inventory_ids[(n * 7919) % len(self.inventory_ids)]
+
+    def supplier_id(self, n):
+        """ Returns a seeded supplier id """
+        return (n * 31) % self.suppliers + 1
+
+
+def make_item(n, suppliers):
+    """ Returns the JSON of the n-th generated inventory item """
+    supplier_id = n % suppliers + 1
+    return {
+        "product_id": n,
+        "product_name": "product{}".format(n),
+        "quantity": n % 200,
+        "restock_threshold": 50,
+        "supplier_id": supplier_id,
+        "supplier_name": "supplier{}".format(supplier_id),
+        "unit_price": round(1 + (n % 1000) / 100, 2),
+        "supplier_status": "disabled" if n % 50 == 0 else "enabled",
+    }
+
+
+def make_csv(items):
+    """ Returns items as a CSV upload with a header line """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(items[0]))
+    writer.writeheader()
+    writer.writerows(items)
+    return buffer.getvalue()
+
+
+def import_range(n):
+    """ Returns the first and past-the-end product ids of the n-th import """
+    start = IMPORT_BASE + n * IMPORT_ROWS
+    return start, start + IMPORT_ROWS
+
+
+# name -> (function of (context, n) returning (method, path, body), expected statuses)
+# a body is sent as JSON, or as a CSV upload when it is a string
+SCENARIOS = [
+    ("index", lambda ctx, n: ("GET", "/", None), (200,)),
+    ("create", lambda ctx, n: ("POST", "/inventory", make_item(n, ctx.suppliers)), (201,)),
+    ("bulk_create", lambda ctx, n: (
+        "POST", "/inventory/bulk", [make_item(n * 10 + i, ctx.suppliers) for i in range(10)]
+    ), (201,)),
+    ("list_all", lambda ctx, n: ("GET", "/inventory", None), (200,)),
+    ("list_page", lambda ctx, n: (
+        "GET", "/inventory?limit=100&cursor={}".format(ctx.inventory_id(n)), None
+    ), (200,)),
+    ("list_filtered", lambda ctx, n: (
+        "GET", "/inventory?supplier_id={}&quantity_lte=100".format(ctx.supplier_id(n)), None
+    ), (200,)),
+    ("stream", lambda ctx, n: ("GET", "/inventory?stream=1&supplier_id={}".format(ctx.supplier_id(n)), None), (200,)),
+    ("restock", lambda ctx, n: ("GET", "/inventory/restock?supplier_id={}".format(ctx.supplier_id(n)), None), (200,)),
+    ("summary", lambda ctx, n: ("GET", "/inventory/summary", None), (200,)),
+    ("export", lambda ctx, n: ("GET", "/inventory/export?supplier_id={}".format(ctx.supplier_id(n)), None), (200,)),
+    ("changes", lambda ctx, n: ("GET", "/inventory/changes?after={}&limit=100".format(n), None), (200,)),
+    # wait=0 sends what is there and ends the stream; past CHANGES_MAX_WAITERS streams get 503
+    ("changes_stream", lambda ctx, n: (
+        "GET", "/inventory/changes/stream?after={}&wait=0".format(n), None
+    ), (200, 503)),
+    ("get", lambda ctx, n: ("GET", "/inventory/{}".format(ctx.inventory_id(n)), None), (200,)),
+    # two threads may update the same item, the loser gets a 409
+    ("update", lambda ctx, n: (
+        "PUT", "/inventory/{}".format(ctx.inventory_id(n)), make_item(n, ctx.suppliers)
+    ), (200, 409)),
+    ("adjust_quantity", lambda ctx, n: (
+        "PATCH", "/inventory/{}/quantity".format(ctx.inventory_id(n)), {"delta": 1}
+    ), (200,)),
+    ("import", lambda ctx, n: (
+        "POST", "/inventory/import", make_csv([make_item(k, ctx.suppliers) for k in range(*import_range(n))])
+    ), (201,)),
+    # removes what the import of the same n added
+    ("delete_filtered", lambda ctx, n: (
+        "DELETE", "/inventory?product_id_gte={}&product_id_lt={}".format(*import_range(n)), None
+    ), (200,)),
+    ("toggle_supplier", lambda ctx, n: ("PUT", "/inventory/supplier/{}".format(ctx.supplier_id(n)), None), (200,)),
+    ("delete", lambda ctx, n: ("DELETE", "/inventory/{}".format(ctx.delete_ids[n % len(ctx.delete_ids)]), None), (204,)),
+    ("pool", lambda ctx, n: ("GET", "/internal/pool", None), (200,)),
+    ("metrics", lambda ctx, n: ("GET", "/metrics", None), (200,)),
+]
+
+
+def request(base_url, method, path, body=None):
+    """ Sends one request and returns its status and the JSON it sent back, if any """
+    url = urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+    try:
+        headers = {"Connection": "close"}
+        data = None
+        if isinstance(body, str):
+            data = body
+            headers["Content-Type"] = "text/csv"
+        elif body is not None:
+            data = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        connection.request(method, url.path.rstrip("/") + path, data, headers)
+        response = connection.getresponse()
+        payload = response.read()
+        if response.getheader("Content-Type", "").startswith("application/json") and payload:
+            return response.status, json.loads(payload)
+        return response.status, None
+    finally:
+        connection.close()
+
+
+def seed(base_url, rows, extra):
+    """ Creates rows + extra inventory items and returns the Context for them """
+    suppliers = max(rows // ROWS_PER_SUPPLIER, 1)
+    inventory_ids = []
+    for start in range(0, rows + extra, SEED_BATCH_SIZE):
+        items = [make_item(n, suppliers) for n in range(start, min(start + SEED_BATCH_SIZE, rows + extra))]
+        code, data = request(base_url, "POST", "/inventory/bulk?atomic=true", items)
+        if code != 201:
+            raise RuntimeError("Seeding failed with {}: {}".format(code, data))
+        inventory_ids.extend(data["inventory_ids"])
+    return Context(inventory_ids[:rows], inventory_ids[rows:], suppliers)
+
+
+def percentile(values, fraction):
+    """ Returns the nearest-rank percentile of sorted values """
+    if not values:
+        return 0.0
+    index = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def run_scenario(base_url, context, make_request, expected, requests, concurrency):
+    """ Sends a scenario's requests from concurrent threads and summarizes the latencies """
+    latencies = []
+    errors = []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            method, path, body = make_request(context, n)
+            started = time.perf_counter()
+            try:
+                code, _ = request(base_url, method, path, body)
+            except (OSError, http.client.HTTPException) as error:
+                code = str(error)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if code not in expected:
+                    errors.append(code)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 2) if seconds else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def compare(baseline, results, threshold):
+    """ Returns the names of the routes that regressed against the baseline """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = base["p95_ms"] and result["p95_ms"] > base["p95_ms"] * (1 + threshold)
+        fewer = base["throughput"] and result["throughput"] < base["throughput"] * (1 - threshold)
+        if slower or fewer:
+            regressions.append(name)
+    return regressions
+
+
+def start_server(database_uri, reset):
+    """ Runs the service in a background thread and returns its base URL """
+    os.environ["DATABASE_URI"] = database_uri
+    from werkzeug.serving import make_server
+    from service import app, init_db
+    from service.models import db
+
+    app.logger.setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # one line per request
+    if reset:
+        with app.app_context():
+            db.drop_all()
+    init_db(app)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def print_report(results, baseline=None, regressions=()):
+    """ Prints a table of the results, marking the regressions """
+    print("{:<16} {:>8} {:>6} {:>10} {:>9} {:>9} {:>9}".format(
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"
+    ))
+    for name, result in results.items():
+        line = "{:<16} {:>8} {:>6} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            name, result["requests"], result["errors"], result["throughput"],
+            result["p50_ms"], result["p95_ms"], result["p99_ms"]
+        )
+        if baseline and name in baseline:
+            line += "   (baseline p95 {:.2f}, {:.1f} req/s)".format(
+                baseline[name]["p95_ms"], baseline[name]["throughput"]
+            )
+        if name in regressions:
+            line += "  REGRESSION"
+        print(line)
+
+
+def main(argv=None):
+    """ Runs the benchmark from the command line """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running service instead of starting one")
+    parser.add_argument("--database-uri", help="database for the in-process service (default: a new SQLite file)")
+    parser.add_argument("--reset", action="store_true", help="drop the tables of --database-uri first")
+    parser.add_argument("--rows", type=int, default=10000, help="inventory items to seed")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--routes", help="comma separated routes to run (default: all)")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown as a fraction")
+    args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS
+    if args.routes:
+        names = args.routes.split(",")
+        scenarios = [scenario for scenario in SCENARIOS if scenario[0] in names]
+
+    base_url = args.url
+    if base_url is None:
+        database_uri = args.database_uri or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "inventory.db")
+        base_url = start_server(database_uri, args.reset)
+
+    print("Seeding {} inventory items at {}".format(args.rows, base_url))
+    context = seed(base_url, args.rows, args.requests)
+
+    results = {}
+    for name, make_request, expected in scenarios:
+        results[name] = run_scenario(base_url, context, make_request, expected, args.requests, args.concurrency)
+
+    report = {
+        "meta": {
+            "date": datetime.utcnow().isoformat(),
+            "rows": args.rows,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "url": args.url,
+            "database_uri": None if args.url else database_uri.split("@")[-1],
+            "python": platform.python_version(),
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+
+    baseline = None
+    regressions = []
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compare(baseline, results, args.threshold)
+    print_report(results, baseline, regressions)
+
+    failed = [name for name, result in results.items() if result["errors"]]
+    if failed:
+        print("Unexpected responses from: {}".format(", ".join(failed)))
+    if regressions:
+        print("Regressed by more than {:.0%}: {}".format(args.threshold, ", ".join(regressions)))
+    return 1 if regressions or failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
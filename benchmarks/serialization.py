@@ -0,0 +1,96 @@
+"""
+Serialization Microbenchmark
+
+Times the two ways of turning a listing into JSON: building InventoryItems
+and calling serialize() on each, or selecting plain rows with find_rows()
+and calling serialize_row().
+
+    python -m benchmarks.serialization --rows 100000 --repeat 3
+
+It runs on an in-memory SQLite database unless --database-uri is given
+(use --reset to empty that one first, so only point it at a scratch database).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+SEED_BATCH_SIZE = 10000
+
+
+def seed(db, table, rows):
+    """ Inserts rows generated inventory items with one executemany per batch """
+    for start in range(0, rows, SEED_BATCH_SIZE):
+        db.session.execute(table.insert(), [
+            {
+                "product_id": n,
+                "product_name": "product{}".format(n),
+                "quantity": n % 200,
+                "restock_threshold": 50,
+                "supplier_id": n % 1000,
+                "supplier_name": "supplier{}".format(n % 1000),
+                "unit_price": 9.99,
+                "supplier_status": "enabled",
+            }
+            for n in range(start, min(start + SEED_BATCH_SIZE, rows))
+        ])
+    db.session.commit()
+
+
+def best_of(repeat, function, session):
+    """ Returns the shortest of repeat timings of a function, in seconds """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+        # a fresh session each time, as every request gets
+        session.remove()
+    return min(timings)
+
+
+def main(argv=None):
+    """ Runs the microbenchmark from the command line """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="inventory items to list")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each path, the best one counts")
+    parser.add_argument("--database-uri", default="sqlite://", help="database to list from")
+    parser.add_argument("--reset", action="store_true", help="drop the tables of --database-uri first")
+    args = parser.parse_args(argv)
+
+    os.environ["DATABASE_URI"] = args.database_uri
+    from service import app
+    from service.models import InventoryItem, db
+
+    app.logger.setLevel(logging.WARNING)
+    app.config["SLOW_QUERY_MS"] = 0
+    InventoryItem.init_db(app)
+    if args.reset:
+        db.drop_all()
+        InventoryItem.create_schema()
+    print("Seeding {} inventory items".format(args.rows))
+    seed(db, InventoryItem.__table__, args.rows)
+
+    def orm_path():
+        return json.dumps([item.serialize() for item in InventoryItem.query.order_by(InventoryItem.inventory_id)])
+
+    def rows_path():
+        return json.dumps([InventoryItem.serialize_row(row) for row in InventoryItem.find_rows([])])
+
+    if orm_path() != rows_path():
+        print("The two paths produced different JSON")
+        return 1
+
+    orm_seconds = best_of(args.repeat, orm_path, db.session)
+    rows_seconds = best_of(args.repeat, rows_path, db.session)
+    print("{:<28} {:>10} {:>14}".format("path", "seconds", "rows/second"))
+    print("{:<28} {:>10.3f} {:>14,.0f}".format("InventoryItem.serialize()", orm_seconds, args.rows / orm_seconds))
+    print("{:<28} {:>10.3f} {:>14,.0f}".format("find_rows + serialize_row", rows_seconds, args.rows / rows_seconds))
+    print("speedup: {:.1f}x".format(orm_seconds / rows_seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,17 +22,15 @@ from selenium.webdriver.support import expected_conditions
 def step_impl(context):
     """ Delete all Inventory Items and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the items and delete them one by one
-    context.resp = requests.get(context.base_url + '/inventory', headers=headers)
+    # delete every item with a single request
+    context.resp = requests.delete(context.base_url + '/inventory?confirm=true', headers=headers)
     expect(context.resp.status_code).to_equal(200)
-    for item in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/inventory/' + str(item["inventory_id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
 
-    # load the database with new inventory items
-    create_url = context.base_url + '/inventory'
+    # load the database with new inventory items in one request
+    create_url = context.base_url + '/inventory/bulk?atomic=true'
+    items = []
     for row in context.table:
-        data = {
+        items.append({
             "product_name": row['product_name'],
             "product_id": row['product_id'],
             "supplier_name": row['supplier_name'],
@@ -41,10 +39,10 @@ def step_impl(context):
             "quantity": row['quantity'],
             "unit_price": row['unit_price'],
             "supplier_status": row['supplier_status']
-        }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+        })
+    payload = json.dumps(items)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(201)
 
 
 @when('I visit the "home page"')
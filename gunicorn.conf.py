@@ -0,0 +1,71 @@
+"""
+Gunicorn configuration for running the Inventory Service in production
+
+    gunicorn --config gunicorn.conf.py service:app
+
+Workers and threads are sized from the CPU count and can be overridden with
+WEB_CONCURRENCY and GUNICORN_THREADS. The app is loaded once in the master,
+which creates the schema a single time before any worker exists, and every
+worker then opens its own database connections.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "8080"))
+
+# one process per core plus one, each serving requests on a few threads
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+
+# import the app in the master and create the schema there, not in every worker
+preload_app = True
+
+accesslog = "-"
+errorlog = "-"
+
+# the workers add up their metrics through files here, read when the app loads
+if not os.getenv("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="inventory-metrics-")
+
+
+def when_ready(server):
+    """ Creates or migrates the schema once, in the master, before any worker starts """
+    from service import app, init_db
+    try:
+        init_db(app)
+    except Exception as error:
+        server.log.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
+    # the metrics of an earlier run would be added to this one's
+    store = app.extensions.get("inventory_metrics_store")
+    if store is not None:
+        store.clear()
+
+
+def pre_fork(server, worker):
+    """
+    Closes the master's database connections before a worker is forked
+
+    A connection opened before the fork would be shared by every worker,
+    so the master drops its pool and each worker starts with an empty one.
+    """
+    from service import app
+    from service.models import db
+    with app.app_context():
+        db.engine.dispose()
+
+
+def worker_exit(server, worker):
+    """ Writes the quantity changes a worker still has queued, and its last metrics, before it exits """
+    from service import app
+    coalescer = app.extensions.get("inventory_coalescer")
+    if coalescer is not None:
+        coalescer.stop()
+    store = app.extensions.get("inventory_metrics_store")
+    if store is not None:
+        store.write()
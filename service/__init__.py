@@ -1,44 +1,84 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module creates and configures the Flask app and sets up the logging.
+The database is not touched until the first request, or until init_db()
+is called (gunicorn does that once in the master, `flask init-db` by hand)
 """
-import os
-import sys
 import logging
+from datetime import datetime, timedelta
 from flask import Flask
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object("config")
-
-# Import the routes After the Flask app is created
-from service import routes, models
-
-# Set up logging for production
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter(
-        "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
-    )
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info(" I N V E N T O R Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    routes.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service initialized!")
+from service import coalescer, metrics, profiler
+from service.models import InventoryChange, InventoryItem
+from service.routes import api
+
+
+def create_app(config="config"):
+    """
+    Creates and configures a Flask app for the Inventory Service
+
+    Args:
+        config: the module or object to load the configuration from
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    _set_up_logging(app)
+
+    # binds the database lazily, the engine is only made on first use
+    InventoryItem.init_app(app)
+    app.register_blueprint(api)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    coalescer.init_app(app)
+
+    @app.before_first_request
+    def init_db_on_first_request():
+        """ Checks the tables before the first request if nothing did yet """
+        init_db(app)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """ Creates or migrates the inventory tables """
+        init_db(app)
+
+    @app.cli.command("prune-changes")
+    def prune_changes_command():
+        """ Deletes change feed records older than CHANGES_RETENTION_HOURS """
+        cutoff = datetime.utcnow() - timedelta(hours=app.config["CHANGES_RETENTION_HOURS"])
+        app.logger.info("Pruned %d inventory changes", InventoryChange.prune(cutoff))
+
+    app.logger.info(70 * "*")
+    app.logger.info(" I N V E N T O R Y   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+    return app
+
+
+def init_db(app):
+    """ Creates or migrates the tables of an app, once per process """
+    if app.extensions.get("inventory_schema"):
+        return
+    with app.app_context():
+        InventoryItem.create_schema()
+    app.extensions["inventory_schema"] = True
+    app.logger.info("Service initialized!")
+
+
+def _set_up_logging(app):
+    """ Sends the app's log to gunicorn's log with a consistent format """
+    if __name__ != "__main__":
+        gunicorn_logger = logging.getLogger("gunicorn.error")
+        app.logger.handlers = gunicorn_logger.handlers
+        app.logger.setLevel(gunicorn_logger.level)
+        app.logger.propagate = False
+        # Make all log formats consistent
+        formatter = logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
+        )
+        for handler in app.logger.handlers:
+            handler.setFormatter(formatter)
+        app.logger.info("Logging handler established")
+
+
+# The app that gunicorn and flask run as service:app
+app = create_app()
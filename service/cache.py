@@ -0,0 +1,197 @@
+"""
+Item Cache
+
+An optional read-through cache of serialized InventoryItems keyed by
+inventory_id. The backend is picked from the app configuration:
+
+CACHE_BACKEND = "none"   - no caching (the default)
+CACHE_BACKEND = "memory" - a bounded LRU cache with a TTL inside each worker
+CACHE_BACKEND = "redis"  - a store shared by every worker at CACHE_URL
+
+Each Flask app keeps its own backend, and item_cache uses the one of the
+current app. The memory backend is only invalidated in the worker that made
+the change, so other workers can serve a stale item for up to CACHE_TTL
+seconds. Use the redis backend when running more than one worker.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger("flask.app")
+
+
+class NullCache():
+    """ A cache that never holds anything """
+
+    def get(self, key):
+        """ Always misses """
+        return None
+
+    def set(self, key, value):
+        """ Drops the value """
+
+    def delete(self, *keys):
+        """ Nothing to remove """
+
+    def clear(self):
+        """ Nothing to remove """
+
+
+class MemoryCache():
+    """ A thread safe LRU cache with a time to live, held in this process """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value for a key, or None if it is missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Stores a value, evicting the least recently used one when full """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        """ Removes keys from the cache """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes everything from the cache """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache():
+    """ A cache shared by every worker, kept in Redis or anything that talks like it """
+
+    def __init__(self, client, ttl=60, prefix="inventory:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """ Returns the value for a key, or None if it is missing or expired """
+        value = self.client.get(self.prefix + str(key))
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        """ Stores a value that expires after the TTL """
+        self.client.set(self.prefix + str(key), json.dumps(value), ex=self.ttl)
+
+    def delete(self, *keys):
+        """ Removes keys from the cache """
+        if keys:
+            self.client.delete(*[self.prefix + str(key) for key in keys])
+
+    def clear(self):
+        """ Removes every key with our prefix from the cache """
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class ItemCache():
+    """ The cache of serialized InventoryItems of the current Flask app """
+
+    def init_app(self, app, backend=None):
+        """
+        Picks the cache backend of an app from its configuration
+
+        Args:
+            app (Flask): the application to read CACHE_* settings from
+            backend: use this backend instead of the configured one
+        """
+        if backend is None:
+            backend = self._create_backend(app.config)
+        logger.info("Using %s for the item cache", type(backend).__name__)
+        app.extensions["inventory_item_cache"] = backend
+
+    @property
+    def backend(self):
+        """ Returns the backend of the current app, or one that holds nothing outside of an app """
+        if has_app_context():
+            backend = current_app.extensions.get("inventory_item_cache")
+            if backend is not None:
+                return backend
+        return NullCache()
+
+    @property
+    def enabled(self):
+        """ Returns False when there is no cache to fill """
+        return not isinstance(self.backend, NullCache)
+
+    @staticmethod
+    def _create_backend(config):
+        """ Creates the backend named by CACHE_BACKEND """
+        name = config.get("CACHE_BACKEND", "none")
+        ttl = config.get("CACHE_TTL", 60)
+        if name == "memory":
+            return MemoryCache(config.get("CACHE_MAX_SIZE", 10000), ttl)
+        if name == "redis":
+            import redis  # only needed when the shared cache is configured
+            return RedisCache(redis.Redis.from_url(config["CACHE_URL"]), ttl)
+        return NullCache()
+
+    def get(self, inventory_id):
+        """ Returns a cached serialized InventoryItem or None """
+        try:
+            return self.backend.get(inventory_id)
+        except Exception as error:  # a broken cache must not break reads
+            logger.warning("Item cache get failed: %s", error)
+            return None
+
+    def set(self, inventory_id, data):
+        """ Caches a serialized InventoryItem """
+        try:
+            self.backend.set(inventory_id, data)
+        except Exception as error:
+            logger.warning("Item cache set failed: %s", error)
+
+    def invalidate(self, *inventory_ids):
+        """
+        Drops InventoryItems that have changed from the cache
+
+        This runs after the write has committed, so a failure is logged and
+        not raised: the entries then expire after the TTL instead.
+        """
+        try:
+            self.backend.delete(*inventory_ids)
+        except Exception as error:
+            logger.error("Item cache invalidation of %s failed: %s", inventory_ids, error)
+
+    def clear(self):
+        """ Drops every InventoryItem from the cache """
+        try:
+            self.backend.clear()
+        except Exception as error:
+            logger.error("Item cache clear failed: %s", error)
+
+
+item_cache = ItemCache()
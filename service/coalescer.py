@@ -0,0 +1,185 @@
+"""
+Write Coalescer
+
+An optional write-behind queue for the quantity changes of
+PATCH /inventory/<inventory_id>/quantity. With COALESCE_WRITES on, each
+change is queued in the worker instead of being committed on its own, and a
+background thread flushes everything queued in one transaction with a single
+UPDATE per item, so a burst of sales of the same item costs one row update.
+
+COALESCE_INTERVAL_MS  - the longest a change waits before it is flushed
+COALESCE_MAX_PENDING  - queued changes that trigger a flush before the interval
+COALESCE_ACK_TIMEOUT  - seconds a request waits for its flush before it is
+                        answered 202 Accepted instead of 200
+
+A request is answered once its change is committed, with the quantity after
+the flush. Changes to the same item inside one flush are added up, so their
+order only matters when the total would overdraw the stock. An item the
+database refuses fails only its own changes. A flush that fails as a whole,
+such as when the database is down, goes back on the queue and is tried again
+on the next tick. The queue is flushed when the worker stops, and changes
+queued after that are applied straight away.
+"""
+import atexit
+import logging
+import threading
+
+from service.models import InventoryItem
+
+logger = logging.getLogger("flask.app")
+
+
+class Ticket():
+    """ The acknowledgement of one queued change, resolved when its flush is done """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def resolve(self, result=None, error=None):
+        """ Records the outcome of the change and wakes whoever waits for it """
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """ Waits for the flush, returns False if it did not happen in time """
+        return self._done.wait(timeout)
+
+    def result(self):
+        """ Returns the outcome of a flushed change, or raises the error that refused it """
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class WriteCoalescer():
+    """ Collects quantity deltas per inventory_id and flushes them together on a timer """
+
+    def __init__(self, app, interval=0.05, max_pending=1000, ack_timeout=5.0):
+        self.app = app
+        self.interval = interval
+        self.max_pending = max_pending
+        self.ack_timeout = ack_timeout
+        self._pending = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+        self._error = None
+
+    def submit(self, inventory_id, delta):
+        """
+        Queues a delta for the quantity of an inventoryItem
+
+        Returns:
+            Ticket: resolved with the same outcome as adjust_quantity once flushed
+        """
+        ticket = Ticket()
+        with self._lock:
+            if not self._stopped:
+                self._pending.setdefault(inventory_id, []).append((delta, ticket))
+                self._count += 1
+                full = self._count >= self.max_pending
+                # started on first use, so a master that preloads the app never owns the thread
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="write-coalescer", daemon=True)
+                    self._thread.start()
+                if full:
+                    self._wake.set()
+                return ticket
+        # the queue has been flushed for good, so write this one directly
+        try:
+            with self.app.app_context():
+                ticket.resolve(InventoryItem.adjust_quantity(inventory_id, delta))
+        except Exception as error:
+            ticket.resolve(error=error)
+        return ticket
+
+    def flush(self):
+        """
+        Writes every queued delta in one transaction and resolves their tickets
+
+        When the transaction fails the deltas are queued again, ahead of any
+        that came in meanwhile, and their tickets stay open.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._count = self._pending, {}, 0
+            if not pending:
+                return 0
+            deltas = {inventory_id: [delta for delta, _ in entries] for inventory_id, entries in pending.items()}
+            try:
+                with self.app.app_context():
+                    outcomes = InventoryItem.adjust_quantities(deltas)
+            except Exception as error:
+                logger.error("Flush of %d queued quantity changes failed, will retry: %s", len(pending), error)
+                with self._lock:
+                    for inventory_id, entries in pending.items():
+                        self._pending[inventory_id] = entries + self._pending.get(inventory_id, [])
+                        self._count += len(entries)
+                    self._error = error
+                return 0
+            flushed = 0
+            for inventory_id, entries in pending.items():
+                for (_, ticket), outcome in zip(entries, outcomes[inventory_id]):
+                    if isinstance(outcome, Exception):
+                        ticket.resolve(error=outcome)
+                    else:
+                        ticket.resolve(outcome)
+                    flushed += 1
+            logger.info("Flushed %d quantity changes to %d inventory items", flushed, len(pending))
+            return flushed
+
+    def stop(self):
+        """ Stops the flush thread and writes whatever is still queued """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            thread = self._thread
+        self._wake.set()
+        if thread is not None:
+            thread.join()
+        self.flush()
+        # the last flush failed too: nothing will write these any more
+        with self._lock:
+            pending, self._pending, self._count = self._pending, {}, 0
+        dropped = sum(len(entries) for entries in pending.values())
+        if dropped:
+            logger.error("Dropped %d queued quantity changes that could not be written", dropped)
+        for entries in pending.values():
+            for _, ticket in entries:
+                ticket.resolve(error=self._error)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopped:
+                # stop() does the last flush itself
+                return
+            try:
+                self.flush()
+            except Exception:  # keep flushing later changes
+                logger.exception("Write coalescer flush failed")
+
+
+def init_app(app):
+    """ Creates the write coalescer of an app when COALESCE_WRITES is on """
+    if not app.config.get("COALESCE_WRITES"):
+        app.extensions.pop("inventory_coalescer", None)
+        return
+    coalescer = WriteCoalescer(
+        app,
+        interval=app.config.get("COALESCE_INTERVAL_MS", 50) / 1000.0,
+        max_pending=app.config.get("COALESCE_MAX_PENDING", 1000),
+        ack_timeout=app.config.get("COALESCE_ACK_TIMEOUT", 5.0),
+    )
+    app.extensions["inventory_coalescer"] = coalescer
+    # gunicorn's worker_exit hook stops it too, this covers every other way out
+    atexit.register(coalescer.stop)
+    logger.info("Coalescing quantity changes every %s ms", app.config.get("COALESCE_INTERVAL_MS", 50))
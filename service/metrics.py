@@ -0,0 +1,324 @@
+"""
+Metrics
+
+Counters and histograms kept in each worker process and rendered in the
+Prometheus text format by GET /metrics:
+
+inventory_http_requests_total             - requests by route, method and status
+inventory_http_request_duration_seconds   - request latency by route and method
+inventory_db_statements_total             - SQL statements by operation
+inventory_db_statement_duration_seconds   - SQL statement latency by operation
+inventory_http_errors_total               - responses made by each error handler
+
+Recording a value is a dictionary update under a lock, cheap enough to leave
+on in production. Set METRICS_ENABLED to false to skip it entirely.
+
+With METRICS_DIR set, every process writes its values to a file of its own in
+that directory about once a second, and GET /metrics adds up the files of all
+of them, so whichever worker answers a scrape reports the whole server. The
+files of workers that have exited are kept, so the counters never go back.
+"""
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds in seconds of the latency buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds between two writes of a worker's values to METRICS_DIR
+WRITE_SECONDS = 1.0
+
+logger = logging.getLogger("flask.app")
+
+
+def _format_labels(names, values):
+    """ Returns the {name="value",...} part of a sample """
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_bound(bound):
+    """ Returns a bucket bound the way Prometheus writes it """
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+class Counter():
+    """ A count that only goes up, kept per combination of label values """
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        """ Adds to the count of the given label values """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """ Returns the count of the given label values """
+        return self._values.get(label_values, 0)
+
+    def snapshot(self):
+        """ Returns a copy of the counts by label values """
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        """ Forgets every count """
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def merge(totals, values):
+        """ Adds the counts of one process to the totals of all of them """
+        for label_values, value in values.items():
+            totals[label_values] = totals.get(label_values, 0) + value
+
+    def render(self, values=None):
+        """ Returns the counter, or the given counts of it, in the Prometheus text format """
+        if values is None:
+            values = self.snapshot()
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} counter".format(self.name)]
+        for label_values, value in sorted(values.items()):
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Histogram():
+    """ A distribution of observed values in fixed buckets, kept per combination of label values """
+
+    def __init__(self, name, documentation, labels=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        """ Records one value for the given label values """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * len(self.buckets), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def count(self, *label_values):
+        """ Returns how many values were observed for the given label values """
+        counts = self._values.get(label_values)
+        return sum(counts[0]) if counts else 0
+
+    def snapshot(self):
+        """ Returns a copy of the bucket counts and sums by label values """
+        with self._lock:
+            return {label_values: [list(buckets), total] for label_values, (buckets, total) in self._values.items()}
+
+    def reset(self):
+        """ Forgets every observed value """
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def merge(totals, values):
+        """ Adds the bucket counts and sums of one process to the totals of all of them """
+        for label_values, (buckets, total) in values.items():
+            counts = totals.setdefault(label_values, [[0] * len(buckets), 0.0])
+            counts[0] = [a + b for a, b in zip(counts[0], buckets)]
+            counts[1] += total
+
+    def render(self, values=None):
+        """ Returns the histogram, or the given values of it, in the Prometheus text format """
+        if values is None:
+            values = self.snapshot()
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        labels = self.labels + ("le",)
+        for label_values, (buckets, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, buckets):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(labels, label_values + (_format_bound(bound),)), cumulative
+                ))
+            suffix = _format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, suffix, repr(total)))
+            lines.append("{}_count{} {}".format(self.name, suffix, cumulative))
+        return lines
+
+
+REQUESTS = Counter(
+    "inventory_http_requests_total", "HTTP requests handled", ("route", "method", "status")
+)
+REQUEST_DURATION = Histogram(
+    "inventory_http_request_duration_seconds", "Time spent handling HTTP requests", ("route", "method")
+)
+STATEMENTS = Counter(
+    "inventory_db_statements_total", "SQL statements executed", ("operation",)
+)
+STATEMENT_DURATION = Histogram(
+    "inventory_db_statement_duration_seconds", "Time spent executing SQL statements", ("operation",),
+    buckets=STATEMENT_BUCKETS
+)
+ERRORS = Counter(
+    "inventory_http_errors_total", "Error responses by error handler", ("handler",)
+)
+ALL_METRICS = (REQUESTS, REQUEST_DURATION, STATEMENTS, STATEMENT_DURATION, ERRORS)
+
+
+class DirectoryStore():
+    """ Shares the values of every process through one file per process in a directory """
+
+    def __init__(self, path, interval=WRITE_SECONDS):
+        self.path = path
+        self.interval = interval
+        self._created_pid = os.getpid()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Starts writing this process's values, once per process """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if pid != self._created_pid:
+                # a forked worker starts with the counts of the master, which are not its own
+                for metric in ALL_METRICS:
+                    metric.reset()
+            self._pid = pid
+        threading.Thread(target=self._run, name="metrics-writer", daemon=True).start()
+
+    def write(self):
+        """ Writes the values of this process to its file """
+        data = {
+            metric.name: [[list(label_values), value] for label_values, value in metric.snapshot().items()]
+            for metric in ALL_METRICS
+        }
+        path = os.path.join(self.path, "metrics-{}.json".format(os.getpid()))
+        with self._lock:
+            with open(path + ".tmp", "w") as file:
+                json.dump(data, file)
+            # replaced in one step, so a reader never sees half a file
+            os.replace(path + ".tmp", path)
+
+    def read(self):
+        """ Returns the values of every process added up, by metric name """
+        totals = {metric.name: {} for metric in ALL_METRICS}
+        for path in glob.glob(os.path.join(self.path, "metrics-*.json")):
+            try:
+                with open(path) as file:
+                    data = json.load(file)
+            except (OSError, ValueError) as error:
+                logger.warning("Cannot read metrics file %s: %s", path, error)
+                continue
+            for metric in ALL_METRICS:
+                values = {tuple(label_values): value for label_values, value in data.get(metric.name, [])}
+                metric.merge(totals[metric.name], values)
+        return totals
+
+    def clear(self):
+        """ Removes the files of an earlier run """
+        for path in glob.glob(os.path.join(self.path, "metrics-*.json*")):
+            os.remove(path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception:  # keep writing later values
+                logger.exception("Writing metrics to %s failed", self.path)
+
+
+def render(store=None):
+    """ Returns every metric in the Prometheus text format, summed over every process of a store """
+    values = {}
+    if store is not None:
+        store.start()
+        store.write()
+        values = store.read()
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render(values.get(metric.name)))
+    return "\n".join(lines) + "\n"
+
+
+def counted_error(handler):
+    """ Decorates an error handler to count the responses it makes """
+    @functools.wraps(handler)
+    def wrapper(error):
+        ERRORS.inc(handler.__name__)
+        return handler(error)
+    return wrapper
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    store = current_app.extensions.get("inventory_metrics_store")
+    if store is not None:
+        store.start()
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        # label by the route pattern, not the path, so ids do not add series
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_DURATION.observe(time.perf_counter() - started, route, request.method)
+        REQUESTS.inc(route, request.method, str(response.status_code))
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["metrics_started"].pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    STATEMENTS.inc(operation)
+    STATEMENT_DURATION.observe(time.perf_counter() - started, operation)
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("metrics_started"):
+        context.connection.info["metrics_started"].pop()
+
+
+def init_app(app):
+    """ Starts recording the requests of an app and the statements of every engine """
+    app.extensions.pop("inventory_metrics_store", None)
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+    if app.config.get("METRICS_DIR"):
+        app.extensions["inventory_metrics_store"] = DirectoryStore(app.config["METRICS_DIR"])
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    # listening on the Engine class also covers engines that are made later
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
@@ -3,13 +3,26 @@ Models for InventoryItem
 
 All of the models are stored in this module
 """
+import io
+import json
 import logging
-from flask_sqlalchemy import SQLAlchemy
+import math
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import inspect, util
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+
+from service.cache import item_cache
+from service.pool import engine_options
+from service import replicas
+from service.replicas import RoutingSQLAlchemy, use_primary
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
@@ -17,23 +30,160 @@ class DataValidationError(Exception):
     pass
 
 
+class VersionConflictError(Exception):
+    """ Used when an inventoryItem was changed by someone else since it was read """
+    pass
+
+
+class InsufficientQuantityError(Exception):
+    """ Used when a quantity change would take the stock below zero """
+    pass
+
+
+# Columns that GET /inventory can filter on, with the type of their values
+FILTER_COLUMNS = {
+    "inventory_id": int,
+    "product_id": int,
+    "product_name": str,
+    "quantity": int,
+    "restock_threshold": int,
+    "supplier_id": int,
+    "supplier_name": str,
+    "unit_price": float,
+    "supplier_status": str,
+}
+# Columns that can also be filtered on a range, and the operators for it
+RANGE_COLUMNS = ("inventory_id", "product_id", "quantity", "restock_threshold", "supplier_id", "unit_price")
+RANGE_OPERATORS = ("gt", "gte", "lt", "lte")
+# Other names a filter can be given by
+FILTER_ALIASES = {"status": "supplier_status"}
+
+# Indexes that earlier versions created and no query uses any more
+OBSOLETE_INDEXES = ("ix_inventory_item_updated_at",)
+
+# Range of the Integer columns: 32 bits on PostgreSQL, and kept by the service
+# on SQLite, which would store larger numbers
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+# Advisory lock id that serializes schema creation between processes
+SCHEMA_LOCK_KEY = 0x1E7E4701
+# Advisory lock id that makes writers commit their outbox changes in sequence order
+OUTBOX_LOCK_KEY = 0x1E7E4702
+
+
+def _filter_criterion(column, operator, param):
+    """ Compares a column against a bound parameter with a filter operator """
+    if operator == "in":
+        return column.in_(db.bindparam(param, expanding=True))
+    if operator == "gt":
+        return column > db.bindparam(param)
+    if operator == "gte":
+        return column >= db.bindparam(param)
+    if operator == "lt":
+        return column < db.bindparam(param)
+    if operator == "lte":
+        return column <= db.bindparam(param)
+    return column == db.bindparam(param)
+
+
+def _isoformat(value):
+    """ Formats a datetime for JSON, leaving None alone """
+    return value.isoformat() if value is not None else None
+
+
+def _supports_returning():
+    """ Returns True when the database can send back rows from INSERT/UPDATE """
+    return db.engine.dialect.name == "postgresql"
+
+
+def _supports_copy():
+    """ Returns True when the database can load rows with COPY ... FROM STDIN """
+    return db.engine.dialect.name == "postgresql"
+
+
+def _supports_upsert():
+    """ Returns True when the database can do INSERT ... ON CONFLICT DO UPDATE """
+    return db.engine.dialect.name == "postgresql"
+
+
+def _text(data, name, length):
+    """ Returns a text field of an inventoryItem that fits in its column """
+    value = data[name]
+    if not isinstance(value, str):
+        raise DataValidationError("Invalid InventoryItem: {} must be text, not {!r}".format(name, value))
+    if len(value) > length:
+        raise DataValidationError("Invalid InventoryItem: {} must be at most {} characters".format(name, length))
+    return value
+
+
+def _coerce(kind, data, name):
+    """
+    Converts a numeric field of an inventoryItem, which may arrive as a string
+
+    Booleans, integer fields with a fraction and floats that are not finite
+    are refused rather than truncated or stored.
+    """
+    value = data[name]
+    try:
+        if isinstance(value, bool):
+            raise ValueError(value)
+        if kind is int and isinstance(value, float) and not value.is_integer():
+            raise ValueError(value)
+        number = kind(value)
+        if kind is float and not math.isfinite(number):
+            raise ValueError(value)
+    except (TypeError, ValueError, OverflowError):
+        kind_name = "a whole number" if kind is int else "a finite number"
+        raise DataValidationError(
+            "Invalid InventoryItem: {} must be {}, not {!r}".format(name, kind_name, value)
+        )
+    if kind is int and not INTEGER_MIN <= number <= INTEGER_MAX:
+        raise DataValidationError(
+            "Invalid InventoryItem: {} must be between {} and {}".format(name, INTEGER_MIN, INTEGER_MAX)
+        )
+    return number
+
+
 class InventoryItem(db.Model):
     """
     Class that represents an inventory item
     """
     app = None
+    # the list selects by filter shape, and their compiled SQL
+    _selects = util.LRUCache(200)
+    _compiled = util.LRUCache(200)
 
     # Table Schema
     inventory_id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, nullable=False)
-    product_name = db.Column(db.String(63), nullable=False)
+    product_name = db.Column(db.String(63), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     restock_threshold = db.Column(db.Integer)
     supplier_id = db.Column(db.Integer, nullable=False)
     supplier_name = db.Column(db.String(63))
     unit_price = db.Column(db.Float, nullable=False)
     # todo: this should probably be a enumerable
-    supplier_status = db.Column(db.String(63), nullable=False)
+    supplier_status = db.Column(db.String(63), nullable=False, index=True)
+    # Last time the row changed, used for ETags. Also set by Core UPDATEs.
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Bumped on every change. The ORM only updates a row whose version still
+    # matches the one it read, so concurrent writers cannot lose updates.
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Indexes for the find_by_* lookups. The composite indexes also serve
+    # lookups on their leading column alone (supplier_id, supplier_name).
+    __table_args__ = (
+        db.Index("ix_inventory_item_supplier_id_status", "supplier_id", "supplier_status"),
+        db.Index("ix_inventory_item_supplier_name_product", "supplier_name", "product_name"),
+        # partial index holding only the items that need restocking
+        db.Index(
+            "ix_inventory_item_restock", "supplier_id", "inventory_id",
+            postgresql_where=quantity <= restock_threshold,
+            sqlite_where=quantity <= restock_threshold,
+        ),
+    )
+    __mapper_args__ = {"version_id_col": version}
 
     def __repr__(self):
         return "<InventoryItem %r id=[%s]>" % (self.product_name, self.inventory_id)
@@ -45,20 +195,210 @@ class InventoryItem(db.Model):
         logger.info("Creating %s", self.product_name)
         self.inventory_id = None  # id must be none to generate next primary key
         db.session.add(self)
+        db.session.flush()
+        deltas = {}
+        SupplierSummary.add_item(
+            deltas, 1, self.supplier_id, self.supplier_status, self.quantity, self.unit_price
+        )
+        SupplierSummary.apply(deltas)
+        InventoryChange.record([("create", self.inventory_id, self.serialize())])
         db.session.commit()
+        item_cache.invalidate(self.inventory_id)  # ids can be reused after a delete
 
     def save(self):
         """
         Updates an inventoryItem to the database
         """
         logger.info("Saving %s", self.product_name)
-        db.session.commit()
+        inventory_id = self.inventory_id
+        deltas = {}
+        stored = self._stored_summary_fields(inventory_id)
+        if stored is not None:
+            SupplierSummary.add_item(deltas, -1, *stored)
+        SupplierSummary.add_item(
+            deltas, 1, *[getattr(self, name) for name in SupplierSummary.ITEM_FIELDS]
+        )
+        try:
+            db.session.flush()
+            SupplierSummary.apply(deltas)
+            InventoryChange.record([("update", inventory_id, self.serialize())])
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflictError(
+                "Inventory item {} was changed by another request".format(inventory_id)
+            )
+        item_cache.invalidate(inventory_id)
 
     def delete(self):
-        """ Removes an inventoryItem from the data store """
+        """
+        Removes an inventoryItem from the data store
+
+        The row is deleted by its id whatever its version, so an item that
+        changed since it was read is still deleted, and one that is already
+        gone is left alone.
+        """
         logger.info("Deleting %s", self.product_name)
-        db.session.delete(self)
-        db.session.commit()
+        inventory_id = self.inventory_id
+        table = type(self).__table__
+        try:
+            stored = self._stored_summary_fields(inventory_id)
+            if stored is not None:
+                deltas = {}
+                SupplierSummary.add_item(deltas, -1, *stored)
+                db.session.execute(table.delete().where(table.c.inventory_id == inventory_id))
+                SupplierSummary.apply(deltas)
+                InventoryChange.record([("delete", inventory_id, None)])
+            if self in db.session:
+                db.session.expunge(self)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        item_cache.invalidate(inventory_id)
+
+    @classmethod
+    def _stored_summary_fields(cls, inventory_id):
+        """ Reads and locks the stored values that an item adds to its SupplierSummary """
+        table = cls.__table__
+        return db.session.execute(
+            db.select([table.c[name] for name in SupplierSummary.ITEM_FIELDS])
+            .where(table.c.inventory_id == inventory_id)
+            .with_for_update()
+        ).first()
+
+    @classmethod
+    def bulk_create(cls, inventory_items, batch_size):
+        """
+        Creates many inventoryItems in a single transaction
+
+        Rows are written with one multi-row INSERT ... RETURNING per batch
+        where the database supports it. Elsewhere each row is inserted on
+        its own, still inside the one transaction, so the ids can be reported.
+
+        Args:
+            inventory_items (list): deserialized InventoryItems to create
+            batch_size (int): the number of rows written per statement
+
+        Returns:
+            list: the new inventory ids in the same order as the items
+        """
+        logger.info("Bulk creating %d inventory items", len(inventory_items))
+        table = cls.__table__
+        # leave out the key so it gets generated, and fill in the defaults for the change feed
+        columns = [column.name for column in table.columns if not column.primary_key]
+        now = datetime.utcnow()
+        rows = []
+        for item in inventory_items:
+            row = {name: getattr(item, name) for name in columns}
+            row.update(updated_at=now, version=1)
+            rows.append(row)
+        inventory_ids = []
+        try:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                if _supports_returning():
+                    result = db.session.execute(
+                        table.insert().values(batch).returning(table.c.inventory_id)
+                    )
+                    inventory_ids.extend(row[0] for row in result)
+                else:
+                    for row in batch:
+                        result = db.session.execute(table.insert(), row)
+                        inventory_ids.append(result.inserted_primary_key[0])
+            deltas = {}
+            for row in rows:
+                SupplierSummary.add_item(
+                    deltas, 1, *[row[name] for name in SupplierSummary.ITEM_FIELDS]
+                )
+            SupplierSummary.apply(deltas)
+            InventoryChange.record([
+                ("create", inventory_id, cls.serialize_row(dict(row, inventory_id=inventory_id)))
+                for inventory_id, row in zip(inventory_ids, rows)
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        item_cache.invalidate(*inventory_ids)
+        return inventory_ids
+
+    @classmethod
+    def load(cls, inventory_items):
+        """
+        Inserts a chunk of inventoryItems through the fastest bulk path of the database
+
+        PostgreSQL gets a single COPY ... FROM STDIN, with the ids taken from
+        the sequence first so the change feed can name them. Other databases
+        insert row by row. The chunk, its SupplierSummary changes and its
+        change records are committed together.
+
+        Args:
+            inventory_items (list): deserialized InventoryItems to insert
+
+        Returns:
+            int: the number of rows inserted
+        """
+        logger.info("Loading %d inventory items", len(inventory_items))
+        table = cls.__table__
+        columns = [column for column in table.columns if not column.primary_key]
+        now = datetime.utcnow()
+        rows = []
+        for item in inventory_items:
+            row = {column.name: getattr(item, column.name) for column in columns}
+            row.update(updated_at=now, version=1)
+            rows.append(row)
+        try:
+            if _supports_copy():
+                for row, inventory_id in zip(rows, cls._reserve_ids(len(rows))):
+                    row["inventory_id"] = inventory_id
+                cls._copy_rows([table.c.inventory_id] + columns, rows)
+            else:
+                for row in rows:
+                    row["inventory_id"] = db.session.execute(table.insert(), row).inserted_primary_key[0]
+            deltas = {}
+            for row in rows:
+                SupplierSummary.add_item(
+                    deltas, 1, *[row[name] for name in SupplierSummary.ITEM_FIELDS]
+                )
+            SupplierSummary.apply(deltas)
+            InventoryChange.record([("create", row["inventory_id"], cls.serialize_row(row)) for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return len(rows)
+
+    @classmethod
+    def _reserve_ids(cls, count):
+        """ Takes count inventory ids from the PostgreSQL sequence in one round trip """
+        sequence = db.func.pg_get_serial_sequence(cls.__tablename__, "inventory_id")
+        statement = db.select([db.func.nextval(sequence)]).select_from(db.func.generate_series(1, count))
+        return [row[0] for row in db.session.execute(statement)]
+
+    @classmethod
+    def _copy_rows(cls, columns, rows):
+        """ Sends rows to PostgreSQL with COPY in CSV format, on the session's connection """
+        buffer = io.StringIO()
+        # every value is quoted, so an unquoted empty field is the only NULL
+        for row in rows:
+            buffer.write(",".join(
+                "" if row[column.name] is None else '"{}"'.format(str(row[column.name]).replace('"', '""'))
+                for column in columns
+            ))
+            buffer.write("\n")
+        buffer.seek(0)
+        names = ", ".join(column.name for column in columns)
+        statement = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(cls.__tablename__, names)
+        connection = db.session.connection()
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(statement, buffer)
+        except connection.dialect.dbapi.Error as error:
+            # a raw cursor skips SQLAlchemy, so wrap its errors the way SQLAlchemy would
+            raise DBAPIError.instance(statement, None, error, connection.dialect.dbapi.Error) from error
+        finally:
+            cursor.close()
 
     def serialize(self):
         """ Serializes an inventoryItem into a dictionary """
@@ -71,25 +411,82 @@ class InventoryItem(db.Model):
             "supplier_id": self.supplier_id,
             "supplier_name": self.supplier_name,
             "unit_price": self.unit_price,
-            "supplier_status": self.supplier_status
+            "supplier_status": self.supplier_status,
+            "updated_at": _isoformat(self.updated_at),
+            "version": self.version
+        }
+
+    @staticmethod
+    def serialize_row(row):
+        """ Serializes a database row of an inventoryItem into a dictionary """
+        return {
+            "inventory_id": row["inventory_id"],
+            "product_id": row["product_id"],
+            "product_name": row["product_name"],
+            "quantity": row["quantity"],
+            "restock_threshold": row["restock_threshold"],
+            "supplier_id": row["supplier_id"],
+            "supplier_name": row["supplier_name"],
+            "unit_price": row["unit_price"],
+            "supplier_status": row["supplier_status"],
+            "updated_at": _isoformat(row["updated_at"]),
+            "version": row["version"]
         }
 
+    @staticmethod
+    def serialize_columns(row, columns):
+        """ Serializes the given columns of a database row into a dictionary """
+        return {name: _isoformat(row[name]) if name == "updated_at" else row[name] for name in columns}
+
+    @classmethod
+    def parse_columns(cls, value):
+        """
+        Returns the column names listed in a comma separated string, or all of them
+
+        Raises:
+            DataValidationError: when a name is not a column of an inventoryItem
+        """
+        names = [column.name for column in cls.__table__.columns]
+        if not value:
+            return names
+        columns = [name.strip() for name in value.split(",") if name.strip()]
+        unknown = [name for name in columns if name not in names]
+        if unknown or not columns:
+            raise DataValidationError(
+                "Invalid columns: {} (choose from {})".format(", ".join(unknown) or value, ", ".join(names))
+            )
+        return columns
+
     def deserialize(self, data):
         """
         Deserializes an inventoryItem from a dictionary
 
+        When a stored inventoryItem is given a version, it must be the one it
+        is at, else VersionConflictError is raised.
+
         Args:
             data (dict): A dictionary containing the resource data
         """
+        columns = type(self).__table__.c
+        if isinstance(data, dict) and data.get("version") is not None and self.version is not None:
+            version = _coerce(int, data, "version")
+            if version != self.version:
+                raise VersionConflictError(
+                    "Inventory item {} is at version {}, not {}".format(self.inventory_id, self.version, version)
+                )
         try:
-            self.product_id = data["product_id"]
-            self.product_name = data["product_name"]
-            self.quantity = data["quantity"]
+            self.product_id = _coerce(int, data, "product_id")
+            self.product_name = _text(data, "product_name", columns.product_name.type.length)
+            self.quantity = _coerce(int, data, "quantity")
             self.restock_threshold = data["restock_threshold"]
-            self.supplier_id = data["supplier_id"]
+            if self.restock_threshold is not None:
+                self.restock_threshold = _coerce(int, data, "restock_threshold")
+            self.supplier_id = _coerce(int, data, "supplier_id")
             self.supplier_name = data["supplier_name"]
-            self.unit_price = data["unit_price"]
-            self.supplier_status = data["supplier_status"]
+            if self.supplier_name is not None:
+                self.supplier_name = _text(data, "supplier_name", columns.supplier_name.type.length)
+            self.unit_price = _coerce(float, data, "unit_price")
+            self.supplier_status = _text(data, "supplier_status", columns.supplier_status.type.length)
         except KeyError as error:
             raise DataValidationError(
                 "Invalid InventoryItem: missing " + error.args[0]
@@ -101,14 +498,352 @@ class InventoryItem(db.Model):
         return self
 
     @classmethod
-    def init_db(cls, app):
-        """ Initializes the database session """
-        logger.info("Initializing database")
+    def toggle_supplier_status(cls, supplier_id):
+        """
+        Flips the supplier_status of every inventoryItem from a supplier
+
+        Enabled items become disabled and disabled items become enabled with a
+        single UPDATE ... CASE statement, so the whole supplier changes in one
+        transaction. The changed rows come back through RETURNING where the
+        database supports it.
+
+        Args:
+            supplier_id (int): the supplier whose InventoryItems are toggled
+
+        Returns:
+            list: the serialized InventoryItems that were changed
+        """
+        logger.info("Toggling supplier status for supplier id %s ...", supplier_id)
+        table = cls.__table__
+        where = table.c.supplier_id == supplier_id
+        statement = table.update().where(where).values(
+            supplier_status=db.case(
+                [(table.c.supplier_status == "enabled", "disabled")], else_="enabled"
+            ),
+            version=table.c.version + 1
+        )
+        try:
+            if _supports_returning():
+                rows = db.session.execute(statement.returning(*table.c)).fetchall()
+            else:
+                db.session.execute(statement)
+                rows = db.session.execute(table.select().where(where)).fetchall()
+            # only the rows this UPDATE flipped, an item committed meanwhile was not
+            deltas = {}
+            for row in rows:
+                fields = [row[name] for name in SupplierSummary.ITEM_FIELDS]
+                SupplierSummary.add_item(deltas, 1, *fields)
+                fields[1] = "disabled" if row["supplier_status"] == "enabled" else "enabled"
+                SupplierSummary.add_item(deltas, -1, *fields)
+            SupplierSummary.apply(deltas)
+            rows.sort(key=lambda row: row["inventory_id"])
+            InventoryChange.record([("update", row["inventory_id"], cls.serialize_row(row)) for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        item_cache.invalidate(*[row["inventory_id"] for row in rows])
+        return [cls.serialize_row(row) for row in rows]
+
+    @classmethod
+    def count_by_filters(cls, filters):
+        """ Returns how many inventoryItems match filters from parse_filters """
+        criteria, params = cls._filter_clauses(filters)
+        statement = db.select([db.func.count()]).select_from(cls.__table__).where(db.and_(*criteria))
+        return db.session.execute(statement, params).scalar()
+
+    @classmethod
+    def delete_by_filters(cls, filters):
+        """
+        Deletes every inventoryItem matching filters with a single DELETE
+
+        The deleted rows come back through RETURNING where the database
+        supports it, otherwise they are selected first in the same
+        transaction, so the SupplierSummary and the cache can follow.
+
+        Args:
+            filters (list): (column name, operator, value) tuples from parse_filters
+
+        Returns:
+            int: the number of InventoryItems deleted
+        """
+        logger.info("Deleting inventory items matching %s ...", filters)
+        table = cls.__table__
+        criteria, params = cls._filter_clauses(filters)
+        where = db.and_(*criteria)
+        columns = [table.c.inventory_id] + [table.c[name] for name in SupplierSummary.ITEM_FIELDS]
+        try:
+            if _supports_returning():
+                rows = db.session.execute(table.delete().where(where).returning(*columns), params).fetchall()
+            else:
+                rows = db.session.execute(db.select(columns).where(where), params).fetchall()
+                db.session.execute(table.delete().where(where), params)
+            deltas = {}
+            for row in rows:
+                SupplierSummary.add_item(
+                    deltas, -1, *[row[name] for name in SupplierSummary.ITEM_FIELDS]
+                )
+            SupplierSummary.apply(deltas)
+            InventoryChange.record([("delete", row["inventory_id"], None) for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        item_cache.invalidate(*[row["inventory_id"] for row in rows])
+        return len(rows)
+
+    @classmethod
+    def adjust_quantity(cls, inventory_id, delta):
+        """
+        Adds a signed delta to the quantity of an inventoryItem
+
+        The change is a single UPDATE ... SET quantity = quantity + delta that
+        only matches while the result stays between zero and INTEGER_MAX, so
+        concurrent stock movements never lose updates and never need the row
+        read first.
+
+        Args:
+            inventory_id (int): the InventoryItem to change
+            delta (int): the amount to add, negative to take stock out
+
+        Returns:
+            dict: the inventory_id, new quantity and version, or None if there
+            is no such InventoryItem
+        """
+        logger.info("Adjusting quantity of id %s by %s ...", inventory_id, delta)
+        try:
+            row = cls._update_quantity(inventory_id, delta)
+            if row is not None:
+                existing = None
+                SupplierSummary.apply({row["supplier_id"]: [0, 0, delta, delta * row["unit_price"]]})
+                InventoryChange.record([("update", inventory_id, cls.serialize_row(row))])
+            else:
+                # nothing matched: no such item, not enough stock or too much of it
+                existing = cls._stored_quantity(inventory_id)
+            db.session.commit()
+        except DataError as error:
+            # the new quantity does not fit the column
+            db.session.rollback()
+            raise DataValidationError("Invalid quantity change: {}".format(error.orig))
+        except Exception:
+            db.session.rollback()
+            raise
+        if row is None:
+            if existing is None:
+                return None
+            raise cls._refused(inventory_id, existing, delta)
+        item_cache.invalidate(inventory_id)
+        return {"inventory_id": row["inventory_id"], "quantity": row["quantity"], "version": row["version"]}
+
+    @classmethod
+    def adjust_quantities(cls, deltas):
+        """
+        Adds queued deltas to the quantities of many inventoryItems in one transaction
+
+        Each item gets a single UPDATE with the sum of its deltas. Only when
+        that sum would take the quantity below zero, or past INTEGER_MAX, are
+        its deltas applied one at a time in the order they came, so just the
+        ones that overdraw (or overfill) the stock are refused. Items are updated in inventory_id order so
+        concurrent flushes lock rows in the same order, each inside a
+        savepoint, so an item the database refuses (an overflow, say) does not
+        take the other items' deltas down with it.
+
+        Args:
+            deltas (dict): inventory_id -> list of signed deltas
+
+        Returns:
+            dict: inventory_id -> one outcome per delta: the inventory_id, new
+            quantity and version, None if there is no such InventoryItem, or
+            the InsufficientQuantityError or DataValidationError that refused it
+        """
+        logger.info("Adjusting quantities of %d inventory items ...", len(deltas))
+        outcomes = {}
+        summary = {}
+        changes = []
+        try:
+            for inventory_id in sorted(deltas):
+                try:
+                    with db.session.begin_nested():
+                        outcomes[inventory_id], row, moved = cls._apply_deltas(inventory_id, deltas[inventory_id])
+                except (DataError, IntegrityError) as error:
+                    # only data errors are this item's own, anything else fails the whole batch
+                    logger.warning("Quantity changes of id %s refused: %s", inventory_id, error.orig)
+                    refused = DataValidationError("Invalid quantity change: {}".format(error.orig))
+                    outcomes[inventory_id] = [refused] * len(deltas[inventory_id])
+                    continue
+                if row is not None:
+                    totals = summary.setdefault(row["supplier_id"], [0, 0, 0, 0.0])
+                    totals[2] += moved
+                    totals[3] += moved * row["unit_price"]
+                    changes.append(("update", inventory_id, cls.serialize_row(row)))
+            SupplierSummary.apply(summary)
+            InventoryChange.record(changes)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        item_cache.invalidate(*outcomes)
+        return outcomes
+
+    @classmethod
+    def _apply_deltas(cls, inventory_id, deltas):
+        """ Applies the deltas of one item, returns their outcomes, the row after them and the stock moved """
+        row = cls._update_quantity(inventory_id, sum(deltas))
+        if row is not None:
+            applied = [row] * len(deltas)
+        else:
+            existing = cls._stored_quantity(inventory_id)
+            if existing is None:
+                return [None] * len(deltas), None, 0
+            applied = []
+            for delta in deltas:
+                stepped = cls._update_quantity(inventory_id, delta)
+                if stepped is None:
+                    applied.append(cls._refused(inventory_id, existing, delta))
+                else:
+                    applied.append(stepped)
+                    row = existing = stepped
+            if row is None:
+                return applied, None, 0
+        moved = sum(delta for delta, outcome in zip(deltas, applied) if not isinstance(outcome, Exception))
+        outcomes = [
+            outcome if isinstance(outcome, Exception) else {
+                "inventory_id": row["inventory_id"], "quantity": row["quantity"], "version": row["version"]
+            }
+            for outcome in applied
+        ]
+        return outcomes, row, moved
+
+    @classmethod
+    def _update_quantity(cls, inventory_id, delta):
+        """ Adds a delta to a quantity unless it would leave the column's range, returns the changed row or None """
+        table = cls.__table__
+        # compared as a BIGINT, so the check itself cannot overflow; SQLite would not refuse the result either
+        checked = db.cast(table.c.quantity, db.BigInteger) + delta
+        statement = table.update().where(
+            db.and_(table.c.inventory_id == inventory_id, checked >= 0, checked <= INTEGER_MAX)
+        ).values(quantity=table.c.quantity + delta, version=table.c.version + 1)
+        # the whole row, for the change feed
+        if _supports_returning():
+            return db.session.execute(statement.returning(*table.c)).first()
+        result = db.session.execute(statement)
+        if not result.rowcount:
+            return None
+        return db.session.execute(table.select().where(table.c.inventory_id == inventory_id)).first()
+
+    @classmethod
+    def _stored_quantity(cls, inventory_id):
+        """ Returns the quantity row of an item, or None if there is no such item """
+        table = cls.__table__
+        return db.session.execute(
+            db.select([table.c.inventory_id, table.c.quantity]).where(table.c.inventory_id == inventory_id)
+        ).first()
+
+    @staticmethod
+    def _refused(inventory_id, existing, delta):
+        """ Returns the error for a quantity change that its stored row did not match """
+        if existing["quantity"] + delta > INTEGER_MAX:
+            return DataValidationError(
+                "Invalid quantity change: inventory item {} would have {}, more than {}".format(
+                    inventory_id, existing["quantity"] + delta, INTEGER_MAX
+                )
+            )
+        return InsufficientQuantityError(
+            "Inventory item {} has {} in stock, cannot change it by {}".format(
+                inventory_id, existing["quantity"], delta
+            )
+        )
+
+    @classmethod
+    def init_app(cls, app):
+        """ Binds the models to a Flask app without connecting to the database """
         cls.app = app
+        # the pool settings have to be in place before the engine is created
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        replicas.init_app(app, engine_options)
+        item_cache.init_app(app)
+
+    @classmethod
+    def init_db(cls, app):
+        """ Initializes the database session """
+        logger.info("Initializing database")
+        cls.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        cls.create_schema()
+
+    @classmethod
+    def create_schema(cls):
+        """ Creates the tables, or adds what existing ones are missing """
+        # only one process at a time may create or migrate the schema
+        with cls.schema_lock(), use_primary(db.session):
+            db.create_all()  # make our sqlalchemy tables
+            cls.create_missing_columns()
+            cls.create_missing_indexes()
+            SupplierSummary.init_summary()
+
+    @staticmethod
+    @contextmanager
+    def schema_lock():
+        """
+        Holds a database wide lock while the schema is created
+
+        Every instance of the service runs init_db when it starts, so on
+        PostgreSQL they queue on an advisory lock instead of racing each
+        other's DDL. Other databases run without the lock.
+        """
+        if db.engine.dialect.name != "postgresql":
+            yield
+            return
+        connection = db.engine.connect()
+        try:
+            logger.info("Waiting for the schema lock")
+            connection.execute(db.text("SELECT pg_advisory_lock(:key)"), key=SCHEMA_LOCK_KEY)
+            yield
+        finally:
+            connection.execute(db.text("SELECT pg_advisory_unlock(:key)"), key=SCHEMA_LOCK_KEY)
+            connection.close()
+
+    @classmethod
+    def create_missing_columns(cls):
+        """
+        Adds the declared columns that an existing table is missing
+
+        create_all() never alters a table that already exists. Added columns
+        are filled in from their default and stay nullable in the database,
+        because not every database can add a NOT NULL column in place.
+        """
+        table = cls.__table__
+        existing = {column["name"] for column in inspect(db.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            logger.info("Adding missing column %s", column.name)
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            db.engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table.name, column.name, column_type))
+            if column.default is not None:
+                value = column.default.arg if column.default.is_scalar else column.default.arg(None)
+                db.engine.execute(table.update().values({column.name: value}))
+
+    @classmethod
+    def create_missing_indexes(cls):
+        """
+        Creates the declared indexes that an existing table is missing
+
+        create_all() only builds indexes together with a brand new table, so
+        deployments whose table predates an index get it added here. Indexes
+        that nothing reads any more are dropped, so writes stop paying for them.
+        """
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(cls.__tablename__)}
+        for index in cls.__table__.indexes:
+            if index.name not in existing:
+                logger.info("Creating missing index %s", index.name)
+                index.create(bind=db.engine)
+        for name in OBSOLETE_INDEXES:
+            if name in existing:
+                logger.info("Dropping unused index %s", name)
+                db.Index(name).drop(bind=db.engine)
 
     @classmethod
     def all(cls):
@@ -122,12 +857,204 @@ class InventoryItem(db.Model):
         logger.info("Processing lookup for id %s ...", inventory_id)
         return cls.query.get(inventory_id)
 
+    @classmethod
+    def find_serialized(cls, inventory_id):
+        """
+        Finds a serialized inventoryItem by its ID, through the item cache
+
+        A miss is read from the primary, as a lagging replica could put an item
+        back in the cache right after a write dropped it.
+
+        Returns:
+            dict: the serialized InventoryItem, or None if there is no such item
+        """
+        data = item_cache.get(inventory_id)
+        if data is None:
+            if item_cache.enabled:
+                with use_primary(db.session):
+                    inventory_item = cls.find(inventory_id)
+            else:
+                inventory_item = cls.find(inventory_id)
+            if not inventory_item:
+                return None
+            data = inventory_item.serialize()
+            item_cache.set(inventory_id, data)
+        return data
+
     @classmethod
     def find_or_404(cls, inventory_id):
         """ Find an inventoryItem by its id """
         logger.info("Processing lookup or 404 for id %s ...", inventory_id)
         return cls.query.get_or_404(inventory_id)
 
+    @classmethod
+    def parse_filters(cls, args, others=None):
+        """Builds the filters for find_rows from query parameters
+
+        A column name matches on equality, or on any of the values when it is
+        repeated (an IN-list). Numeric columns also take range operators as a
+        suffix, such as quantity_gte=10 or unit_price_lt=5. Parameters that are
+        not filters, or that are empty, are ignored, unless the route lists
+        its other parameters: then anything else is rejected, so a misspelled
+        filter cannot widen a delete.
+
+        Args:
+            args (MultiDict): the query parameters of the request
+            others (tuple): the route's parameters that are not filters
+
+        Returns:
+            list: (column name, operator, value) tuples
+
+        Raises:
+            DataValidationError: when a value has the wrong type, or a
+            parameter is unknown to a route that lists its others
+        """
+        filters = []
+        for key in sorted(args.keys()):
+            name, operator = FILTER_ALIASES.get(key, key), "eq"
+            if name not in FILTER_COLUMNS:
+                name, _, operator = key.rpartition("_")
+                if name not in RANGE_COLUMNS or operator not in RANGE_OPERATORS:
+                    if others is not None and key not in others:
+                        raise DataValidationError("Invalid filter: {} is not a filter".format(key))
+                    continue
+            values = [value for value in args.getlist(key) if value != ""]
+            if not values:
+                continue
+            try:
+                values = [FILTER_COLUMNS[name](value) for value in values]
+            except ValueError:
+                raise DataValidationError(
+                    "Invalid filter: {} must be a {}".format(key, FILTER_COLUMNS[name].__name__)
+                )
+            if operator == "eq" and len(values) > 1:
+                filters.append((name, "in", values))
+            else:
+                filters.append((name, operator, values[-1]))
+        return filters
+
+    @classmethod
+    def _filter_clauses(cls, filters):
+        """ Returns the SQL criteria and their bound parameters for filters """
+        criteria = []
+        params = {}
+        for name, operator, value in filters:
+            criteria.append(_filter_criterion(getattr(cls, name), operator, name + "_" + operator))
+            params[name + "_" + operator] = value
+        return criteria, params
+
+    @classmethod
+    def _rows_select(cls, filters, cursor=None, limit=None, columns=None):
+        """
+        Returns a select of rows matching filters, and its bound parameters
+
+        The select only depends on the shape of the filters (columns and
+        operators, not values), so it is built once per shape and kept, which
+        lets _execute_select() reuse its compiled SQL.
+        """
+        params = {name + "_" + operator: value for name, operator, value in filters}
+        if cursor is not None:
+            params["cursor"] = cursor
+        if limit is not None:
+            params["limit"] = limit
+        shape = (tuple((name, operator) for name, operator, _ in filters), tuple(columns or ()), tuple(sorted(params)))
+        statement = cls._selects.get(shape)
+        if statement is None:
+            table = cls.__table__
+            criteria = [_filter_criterion(table.c[name], operator, name + "_" + operator)
+                        for name, operator, _ in filters]
+            if cursor is not None:
+                criteria.append(table.c.inventory_id > db.bindparam("cursor"))
+            selected = [table.c[name] for name in columns] if columns else [table]
+            statement = db.select(selected).where(db.and_(*criteria)).order_by(table.c.inventory_id)
+            if limit is not None:
+                statement = statement.limit(db.bindparam("limit"))
+            cls._selects[shape] = statement
+        return statement, params
+
+    @classmethod
+    def _execute_select(cls, statement, params, **options):
+        """ Runs a select from _rows_select() in the session, compiling it once per database """
+        connection = db.session.connection(clause=statement)
+        return connection.execution_options(compiled_cache=cls._compiled, **options).execute(statement, params)
+
+    @classmethod
+    def find_rows(cls, filters, limit=None, cursor=None):
+        """Returns plain database rows of the inventory items matching filters
+
+        Rows skip building InventoryItems and tracking them in the session,
+        which is most of the cost of a large listing, so read-only responses
+        use them with serialize_row() instead of serialize(). They come in
+        inventory_id order, after the cursor and up to the limit when given.
+
+        Args:
+            filters (list): (column name, operator, value) tuples from parse_filters
+            limit (int): the maximum number of rows to return
+            cursor (int): the inventory_id of the last row of the previous page
+        """
+        logger.info("Processing rows query of %s after cursor %s ...", limit, cursor)
+        statement, params = cls._rows_select(filters, cursor, limit)
+        return cls._execute_select(statement, params).fetchall()
+
+    @classmethod
+    def stream_rows(cls, filters, batch_size, columns=None):
+        """Iterates over plain database rows in batches from a server side cursor
+
+        Only one batch of rows is held in memory at a time, so the whole
+        table can be walked with constant memory.
+
+        Args:
+            filters (list): (column name, operator, value) tuples from parse_filters
+            batch_size (int): the number of rows to fetch per round trip
+            columns (list): the column names to select, all of them when not given
+        """
+        logger.info("Processing streaming query in batches of %s ...", batch_size)
+        statement, params = cls._rows_select(filters, columns=columns)
+        result = cls._execute_select(statement, params, stream_results=True)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    @classmethod
+    def find_restock(cls, filters):
+        """Returns plain database rows of the items at or below their restock threshold
+
+        The comparison runs in the database and is served by the partial
+        index ix_inventory_item_restock. Rows come back ordered by supplier,
+        for serialize_row(), and the select is kept per shape of the filters
+        like those of _rows_select().
+
+        Args:
+            filters (list): (column name, operator, value) tuples from parse_filters
+        """
+        logger.info("Processing restock query for %s ...", filters)
+        params = {name + "_" + operator: value for name, operator, value in filters}
+        shape = ("restock", tuple((name, operator) for name, operator, _ in filters))
+        statement = cls._selects.get(shape)
+        if statement is None:
+            table = cls.__table__
+            criteria = [_filter_criterion(table.c[name], operator, name + "_" + operator)
+                        for name, operator, _ in filters]
+            statement = db.select([table]).where(
+                db.and_(table.c.quantity <= table.c.restock_threshold, *criteria)
+            ).order_by(table.c.supplier_id, table.c.inventory_id)
+            cls._selects[shape] = statement
+        return cls._execute_select(statement, params).fetchall()
+
+    @classmethod
+    def supplier_totals(cls):
+        """Returns the item count, enabled count, quantity and stock value of every supplier
+
+        The totals are computed with a GROUP BY over the whole table, so this
+        is the slow but always exact version of SupplierSummary.all().
+        """
+        logger.info("Processing supplier totals query ...")
+        rows = db.session.execute(SupplierSummary.totals_select().order_by(cls.supplier_id))
+        return [SupplierSummary.serialize_row(row) for row in rows]
+
     @classmethod
     def find_by_product_name(cls, product_name):
         """Returns all InventoryItems with the given name
@@ -167,3 +1094,248 @@ class InventoryItem(db.Model):
         """
         logger.info("Processing supplier status query for %s ...", supplier_status)
         return cls.query.filter(cls.supplier_status == supplier_status)
+
+
+class SupplierSummary(db.Model):
+    """
+    Class that represents the running totals of one supplier's inventory
+
+    Every write to InventoryItem adjusts these rows in the same transaction,
+    so reading the totals costs one row per supplier instead of a scan of
+    every item.
+    """
+
+    # The InventoryItem fields a summary row depends on, in add_item() order
+    ITEM_FIELDS = ("supplier_id", "supplier_status", "quantity", "unit_price")
+
+    # Table Schema
+    supplier_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    enabled_count = db.Column(db.Integer, nullable=False, default=0)
+    total_quantity = db.Column(db.BigInteger, nullable=False, default=0)
+    stock_value = db.Column(db.Float, nullable=False, default=0.0)
+
+    def __repr__(self):
+        return "<SupplierSummary supplier_id=[%s] items=%s>" % (self.supplier_id, self.item_count)
+
+    def serialize(self):
+        """ Serializes a supplierSummary into a dictionary """
+        return self.serialize_row({column.name: getattr(self, column.name) for column in self.__table__.columns})
+
+    @staticmethod
+    def serialize_row(row):
+        """ Serializes a database row of supplier totals into a dictionary """
+        return {
+            "supplier_id": row["supplier_id"],
+            "item_count": row["item_count"],
+            "enabled_count": row["enabled_count"],
+            "total_quantity": row["total_quantity"],
+            "stock_value": row["stock_value"]
+        }
+
+    @staticmethod
+    def add_item(deltas, sign, supplier_id, supplier_status, quantity, unit_price):
+        """
+        Adds (sign=1) or removes (sign=-1) one inventoryItem to a set of deltas
+
+        Args:
+            deltas (dict): supplier_id -> [items, enabled, quantity, value] to update
+        """
+        totals = deltas.setdefault(supplier_id, [0, 0, 0, 0.0])
+        totals[0] += sign
+        totals[1] += sign if supplier_status == "enabled" else 0
+        totals[2] += sign * quantity
+        totals[3] += sign * quantity * unit_price
+
+    @classmethod
+    def apply(cls, deltas):
+        """
+        Adds deltas to the summary rows inside the current transaction
+
+        Suppliers are updated in supplier_id order so concurrent writers lock
+        the rows in the same order, and rows left without items are removed.
+
+        Args:
+            deltas (dict): supplier_id -> [items, enabled, quantity, value] from add_item
+        """
+        table = cls.__table__
+        touched = []
+        for supplier_id in sorted(deltas):
+            item_count, enabled_count, total_quantity, stock_value = deltas[supplier_id]
+            if not (item_count or enabled_count or total_quantity or stock_value):
+                continue
+            touched.append(supplier_id)
+            changes = {
+                "item_count": table.c.item_count + item_count,
+                "enabled_count": table.c.enabled_count + enabled_count,
+                "total_quantity": table.c.total_quantity + total_quantity,
+                "stock_value": table.c.stock_value + stock_value,
+            }
+            values = {
+                "supplier_id": supplier_id,
+                "item_count": item_count,
+                "enabled_count": enabled_count,
+                "total_quantity": total_quantity,
+                "stock_value": stock_value,
+            }
+            if _supports_upsert():
+                db.session.execute(
+                    postgresql_insert(table).values(values).on_conflict_do_update(
+                        index_elements=[table.c.supplier_id], set_=changes
+                    )
+                )
+            else:
+                result = db.session.execute(
+                    table.update().where(table.c.supplier_id == supplier_id).values(changes)
+                )
+                if result.rowcount == 0:
+                    db.session.execute(table.insert().values(values))
+        if touched:
+            db.session.execute(
+                table.delete().where(db.and_(table.c.supplier_id.in_(touched), table.c.item_count <= 0))
+            )
+
+    @staticmethod
+    def totals_select():
+        """ Returns a GROUP BY select of the totals of every supplier """
+        items = InventoryItem.__table__
+        return db.select([
+            items.c.supplier_id,
+            db.func.count().label("item_count"),
+            db.func.sum(db.case([(items.c.supplier_status == "enabled", 1)], else_=0)).label("enabled_count"),
+            db.func.sum(items.c.quantity).label("total_quantity"),
+            db.func.sum(items.c.quantity * items.c.unit_price).label("stock_value"),
+        ]).group_by(items.c.supplier_id)
+
+    @classmethod
+    def rebuild(cls):
+        """ Recomputes every summary row from the inventory items """
+        logger.info("Rebuilding supplier summary")
+        table = cls.__table__
+        try:
+            db.session.execute(table.delete())
+            db.session.execute(table.insert().from_select(
+                ["supplier_id", "item_count", "enabled_count", "total_quantity", "stock_value"],
+                cls.totals_select()
+            ))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def init_summary(cls):
+        """ Builds the summary for deployments whose items predate it """
+        summary_empty = db.session.query(cls.supplier_id).first() is None
+        if summary_empty and db.session.query(InventoryItem.inventory_id).first() is not None:
+            cls.rebuild()
+        db.session.commit()
+
+    @classmethod
+    def all(cls):
+        """ Returns the summary rows of every supplier """
+        logger.info("Processing all SupplierSummaries")
+        return cls.query.order_by(cls.supplier_id).all()
+
+
+class InventoryChange(db.Model):
+    """
+    A change to an inventoryItem, written to the outbox in the transaction that made it
+
+    Every write to InventoryItem appends one change per item it touched, so a
+    change is visible exactly when the write is committed. Consumers read the
+    changes in sequence order and resume after the last sequence they saw.
+    """
+    # AUTOINCREMENT keeps SQLite from reusing sequences once old changes are pruned
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    OPERATIONS = ("create", "update", "delete")
+
+    sequence = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    inventory_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(15), nullable=False)
+    # the serialized InventoryItem after the change as JSON, null for a delete
+    item = db.Column(db.Text)
+    changed_at = db.Column(db.DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<InventoryChange %s %s id=[%s]>" % (self.sequence, self.operation, self.inventory_id)
+
+    @classmethod
+    def record(cls, changes):
+        """
+        Appends changes to the outbox inside the current transaction
+
+        Sequences are handed out when the rows are inserted but become visible
+        when their transaction commits, so on PostgreSQL appending takes a
+        transaction lock held until the commit. Writers then commit their
+        changes in sequence order and a consumer never skips one that commits
+        late. Call it as the last statement before the commit to keep the
+        lock short.
+
+        Args:
+            changes (list): (operation, inventory_id, serialized item or None) tuples
+        """
+        if not changes:
+            return
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(db.select([db.func.pg_advisory_xact_lock(OUTBOX_LOCK_KEY)]))
+        now = datetime.utcnow()
+        db.session.execute(cls.__table__.insert(), [
+            {
+                "inventory_id": inventory_id,
+                "operation": operation,
+                "item": json.dumps(item) if item is not None else None,
+                "changed_at": now,
+            }
+            for operation, inventory_id, item in changes
+        ])
+
+    @staticmethod
+    def serialize_row(row):
+        """ Serializes a database row of an inventoryChange into a dictionary """
+        return {
+            "sequence": row["sequence"],
+            "inventory_id": row["inventory_id"],
+            "operation": row["operation"],
+            "item": json.loads(row["item"]) if row["item"] is not None else None,
+            "changed_at": _isoformat(row["changed_at"]),
+        }
+
+    @classmethod
+    def since(cls, sequence, limit):
+        """ Returns up to limit changes after a sequence, oldest first, as plain rows """
+        table = cls.__table__
+        statement = table.select().where(table.c.sequence > sequence).order_by(table.c.sequence).limit(limit)
+        return db.session.execute(statement).fetchall()
+
+    @classmethod
+    def latest_sequence(cls):
+        """ Returns the sequence of the newest committed change, or 0 before the first one """
+        return db.session.execute(db.select([db.func.max(cls.__table__.c.sequence)])).scalar() or 0
+
+    @classmethod
+    def oldest_sequence(cls):
+        """ Returns the sequence of the oldest change still kept, or None when there are none """
+        return db.session.execute(db.select([db.func.min(cls.__table__.c.sequence)])).scalar()
+
+    @classmethod
+    def prune(cls, older_than):
+        """
+        Deletes the changes made before a datetime and returns how many went
+
+        The newest change is always kept, so latest_sequence() stays the high
+        water mark and consumers behind it can be told what they missed.
+        """
+        logger.info("Pruning inventory changes before %s", older_than)
+        table = cls.__table__
+        latest = db.select([db.func.max(table.c.sequence)]).as_scalar()
+        try:
+            result = db.session.execute(
+                table.delete().where(db.and_(table.c.changed_at < older_than, table.c.sequence < latest))
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return result.rowcount
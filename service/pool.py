@@ -0,0 +1,95 @@
+"""
+Connection Pool
+
+Builds the SQLAlchemy engine options from the DB_POOL_* settings and adds a
+QueuePool that records how long requests wait for a connection, so the pool
+can be watched from GET /internal/pool.
+
+DB_POOL_SIZE         - connections kept open in each worker
+DB_MAX_OVERFLOW      - extra connections opened when the pool is empty
+DB_POOL_TIMEOUT      - seconds to wait for a connection before giving up
+DB_POOL_RECYCLE      - seconds after which a connection is replaced (-1 never)
+DB_POOL_PRE_PING     - test each connection before use, to survive failovers
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ A QueuePool that keeps count of checkouts, waits and timeouts """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+
+
+def engine_options(config):
+    """
+    Returns the create_engine() keyword arguments for the DB_POOL_* settings
+
+    SQLite gets its own pool from Flask-SQLAlchemy that has no size or
+    overflow, so only the settings every pool understands are applied there.
+    """
+    options = {
+        "pool_recycle": config.get("DB_POOL_RECYCLE", -1),
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", False),
+    }
+    if make_url(config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() != "sqlite":
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=config.get("DB_POOL_SIZE", 5),
+            max_overflow=config.get("DB_MAX_OVERFLOW", 10),
+            pool_timeout=config.get("DB_POOL_TIMEOUT", 30),
+        )
+    return options
+
+
+def pool_stats(engine):
+    """ Returns a dictionary of the live state of an engine's connection pool """
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+            timeout=pool.timeout(),
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            stats.update(
+                checkouts=pool.checkouts,
+                timeouts=pool.timeouts,
+                wait_time_total=round(pool.wait_time_total, 6),
+                wait_time_avg=round(pool.wait_time_total / pool.checkouts, 6) if pool.checkouts else 0.0,
+                wait_time_max=round(pool.wait_time_max, 6),
+            )
+    return stats
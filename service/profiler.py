@@ -0,0 +1,135 @@
+"""
+Request Profiler
+
+An opt-in timing breakdown of single requests, and a log of slow SQL.
+
+Send "X-Profile: 1" with a request (or set PROFILE_REQUESTS for every request)
+and the response gets a Server-Timing header:
+
+    Server-Timing: sql;dur=3.1;desc="4 statements", fetch;dur=5.2, serialize;dur=1.4, total;dur=7.9
+
+sql       - time spent executing SQL statements, and how many ran
+fetch     - time spent loading inventory items, the SQL plus reading its rows
+serialize - time spent turning the items into JSON
+total     - time from the start of the request to its response
+
+Any statement slower than the SLOW_QUERY_MS milliseconds of the app it runs
+in is logged with its parameters and the database's plan for it, whether
+profiling is on or not.
+"""
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+PROFILE_HEADER = "X-Profile"
+
+# Statements that can be explained without running them again
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "WITH")
+
+
+def _profile():
+    """ Returns the timings of the current request, or None when it is not profiled """
+    if has_app_context():
+        return g.get("profile")
+    return None
+
+
+def _slow_query_ms():
+    """ Returns the slow statement threshold of the current app, 0 (off) outside of one """
+    if has_app_context():
+        return current_app.config.get("SLOW_QUERY_MS", 0)
+    return 0
+
+
+@contextmanager
+def timed(section):
+    """ Adds the time spent in a block to a section of the current request's profile """
+    profile = _profile()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sections = profile["sections"]
+        sections[section] = sections.get(section, 0.0) + time.perf_counter() - started
+
+
+def explain(conn, statement, parameters):
+    """ Returns the database's plan for a statement as a string """
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    # a raw DBAPI cursor, so the EXPLAIN is neither timed nor profiled itself
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def _log_slow_query(conn, statement, parameters, elapsed):
+    plan = None
+    if statement.lstrip().split(None, 1)[0].upper() in EXPLAINABLE:
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as error:  # the plan is a nice to have
+            plan = "EXPLAIN failed: {}".format(error)
+    logger.warning(
+        "Slow query (%.1f ms): %s\nParameters: %r\nPlan:\n%s", elapsed * 1000, statement, parameters, plan
+    )
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["profile_started"].pop()
+    profile = _profile()
+    if profile is not None:
+        profile["sql_count"] += 1
+        profile["sql_time"] += elapsed
+    threshold = _slow_query_ms()
+    if threshold and elapsed * 1000 >= threshold and not executemany:
+        _log_slow_query(conn, statement, parameters, elapsed)
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("profile_started"):
+        context.connection.info["profile_started"].pop()
+
+
+def _before_request():
+    if current_app.config.get("PROFILE_REQUESTS") or request.headers.get(PROFILE_HEADER) in ("1", "true"):
+        g.profile = {"started": time.perf_counter(), "sql_count": 0, "sql_time": 0.0, "sections": {}}
+
+
+def _after_request(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    total = time.perf_counter() - profile["started"]
+    timings = ['sql;dur={:.3f};desc="{} statements"'.format(profile["sql_time"] * 1000, profile["sql_count"])]
+    for section, seconds in profile["sections"].items():
+        timings.append("{};dur={:.3f}".format(section, seconds * 1000))
+    timings.append("total;dur={:.3f}".format(total * 1000))
+    response.headers["Server-Timing"] = ", ".join(timings)
+    current_app.logger.info("Profile of %s %s: %s", request.method, request.path, response.headers["Server-Timing"])
+    return response
+
+
+def init_app(app):
+    """ Starts profiling requests that ask for it and logging slow statements """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
@@ -0,0 +1,152 @@
+"""
+Read Replicas
+
+Sends the reads of GET and HEAD requests to read replicas of the database,
+chosen round-robin, and everything else to the primary. The replicas are
+listed in DATABASE_REPLICA_URIS (comma separated); without any, every query
+goes to the primary as before.
+
+A request stays on the primary when:
+- it is not a GET or HEAD, so a write and the reads around it agree
+- its session has already written, so it reads its own writes
+- it sends Cache-Control: no-cache, for clients that must see their last write
+- the code runs inside use_primary(), such as the schema checks
+
+A replica that cannot be reached is skipped for REPLICA_RETRY_SECONDS, then
+checked with a SELECT 1 before it gets reads again. When no replica is up
+the reads go to the primary.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.expression import UpdateBase
+
+logger = logging.getLogger("flask.app")
+
+READ_METHODS = ("GET", "HEAD")
+
+
+class ReplicaSet():
+    """ The engines of the read replicas, handed out round-robin while they are healthy """
+
+    def __init__(self, engines, retry_seconds=30):
+        self.engines = list(engines)
+        self.retry_seconds = retry_seconds
+        self._next = 0
+        self._down_until = {}
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, "handle_error", self._on_error)
+
+    def pick(self):
+        """ Returns the next healthy replica engine, or None when none is up """
+        for _ in range(len(self.engines)):
+            with self._lock:
+                engine = self.engines[self._next]
+                self._next = (self._next + 1) % len(self.engines)
+                down_until = self._down_until.get(engine)
+            if down_until is None:
+                return engine
+            if down_until <= time.monotonic() and self.check(engine):
+                return engine
+        return None
+
+    def check(self, engine):
+        """ Runs SELECT 1 on a replica and records whether it is up """
+        try:
+            with engine.connect() as connection:
+                connection.scalar("SELECT 1")
+        except Exception as error:
+            logger.warning("Read replica %s is still down: %s", engine.url.host or engine.url, error)
+            self.mark_down(engine)
+            return False
+        with self._lock:
+            self._down_until.pop(engine, None)
+        logger.info("Read replica %s is back", engine.url.host or engine.url)
+        return True
+
+    def mark_down(self, engine):
+        """ Skips a replica until the retry time has passed """
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_seconds
+
+    def healthy(self, engine):
+        """ Returns True unless the replica is being skipped """
+        return engine not in self._down_until
+
+    def _on_error(self, context):
+        # connection errors, not bad SQL, take a replica out of the rotation
+        if context.is_disconnect or context.connection is None:
+            logger.warning("Read replica %s failed: %s", context.engine.url.host, context.original_exception)
+            self.mark_down(context.engine)
+
+
+class RoutingSession(SignallingSession):
+    """ A Flask-SQLAlchemy session that sends the reads of read-only requests to a replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self._replica(clause)
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+    def _replica(self, clause):
+        """ Returns the replica engine for a statement, or None for the primary """
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+        if self.info.get("wrote") or self.info.get("primary"):
+            return None
+        if not has_request_context() or request.method not in READ_METHODS:
+            return None
+        if "no-cache" in request.headers.get("Cache-Control", ""):
+            return None
+        replicas = self.app.extensions.get("inventory_replicas")
+        if replicas is None:
+            return None
+        # one replica per session, so a request sees a single snapshot
+        replica = self.info.get("replica")
+        if replica is None or not replicas.healthy(replica):
+            replica = self.info["replica"] = replicas.pick()
+        return replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that can read from replicas """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@contextmanager
+def use_primary(session):
+    """ Keeps every query of a session on the primary inside the block """
+    session.info["primary"] = True
+    try:
+        yield
+    finally:
+        session.info.pop("primary", None)
+
+
+def init_app(app, engine_options):
+    """
+    Creates the replica engines listed in SQLALCHEMY_REPLICA_URIS
+
+    Args:
+        app (Flask): the application to read the settings from
+        engine_options (function): returns create_engine() arguments for a config
+    """
+    uris = app.config.get("SQLALCHEMY_REPLICA_URIS") or []
+    if not uris:
+        app.extensions.pop("inventory_replicas", None)
+        return
+    engines = []
+    for uri in uris:
+        options = engine_options(dict(app.config, SQLALCHEMY_DATABASE_URI=uri))
+        engines.append(create_engine(uri, **options))
+    logger.info("Reading from %d replicas", len(engines))
+    app.extensions["inventory_replicas"] = ReplicaSet(engines, app.config.get("REPLICA_RETRY_SECONDS", 30))
@@ -5,55 +5,99 @@ Maintain an accurate count of inventory items and their attributes
 Paths:
 ------
 GET /inventory - Returns a list all of the inventory items
+GET /inventory?limit={n}&cursor={inventory_id} - Returns one page of inventory items
+GET /inventory?{column}={value}&{column}_{gt|gte|lt|lte}={value} - Returns the inventory items matching every filter
+GET /inventory?stream=1 - Streams all of the inventory items (NDJSON with Accept: application/x-ndjson)
+GET /inventory/export?columns={name,...} - Streams the matching inventory items as CSV or NDJSON
+GET /inventory/restock - Returns the inventory items at or below their restock threshold
+GET /inventory/summary - Returns the item count, quantity and stock value of every supplier
+GET /inventory/changes?after={sequence}&wait={seconds} - Long polls for the changes after a sequence
+GET /inventory/changes/stream - Streams the changes as Server-Sent Events, resuming from Last-Event-ID
 GET /inventory/{inventory_id} - Returns an inventory item with a given product id number
 POST /inventory - creates a new inventory item record in the database
-PUT /inventory/{inventory_id} - updates an inventory item record in the database
+POST /inventory/bulk - creates many inventory item records in one transaction
+POST /inventory/import - loads a CSV or NDJSON upload of inventory items in chunks
+PUT /inventory/{inventory_id} - updates an inventory item record in the database (If-Match / version checked)
+PATCH /inventory/{inventory_id}/quantity - atomically adds a signed delta to the quantity of an inventory item
 DELETE /inventory/{inventory_id} - deletes a product in inventory record in the database
+DELETE /inventory?{column}={value} - deletes every matching inventory item (dry_run=true counts them)
+GET /internal/pool - Returns the live state of the database connection pool
+GET /metrics - Returns request, SQL and error metrics in the Prometheus text format
 """
 
 import os
 import sys
+import io
+import csv
+import json
+import hashlib
+import threading
+import time
+from itertools import groupby
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import (
+    Blueprint, Response, current_app, jsonify, request, url_for, make_response, abort, stream_with_context
+)
 from flask_api import status  # HTTP Status Codes
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 from werkzeug.exceptions import NotFound
 
-from service.models import InventoryItem, DataValidationError
+from service import metrics
+from service.profiler import timed
+from service.pool import pool_stats
+from service.models import (
+    InventoryItem, InventoryChange, SupplierSummary, DataValidationError, VersionConflictError,
+    InsufficientQuantityError, INTEGER_MIN, INTEGER_MAX, db
+)
 
-# Import Flask application
-from . import app
+# The routes are registered on each Flask app made by service.create_app()
+api = Blueprint("inventory", __name__)
+
+# Seconds an idle change stream waits before sending a keep-alive comment
+KEEPALIVE_SECONDS = 15
+
+# Seconds a client is asked to wait before trying a busy change feed again
+RETRY_AFTER_SECONDS = 5
+
+
+@api.record_once
+def init_change_waiters(state):
+    """ Limits the change feed requests that may hold a thread while they wait """
+    state.app.extensions["inventory_change_waiters"] = threading.BoundedSemaphore(
+        state.app.config["CHANGES_MAX_WAITERS"]
+    )
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@api.route("/")
 def index():
     """ Root URL response """
-    return app.send_static_file('index.html')
+    return current_app.send_static_file('index.html')
 
 
 ######################################################################
 # ADD A NEW INVENTORY ITEM
 ######################################################################
-@app.route("/inventory", methods=["POST"])
+@api.route("/inventory", methods=["POST"])
 def create_new_inventory_item():
     """
     Creates a new inventory item
     This endpoint will create an inventory item based the data in the body that is posted
     """
-    app.logger.info("Request to create new inventory item")
+    current_app.logger.info("Request to create new inventory item")
     check_content_type("application/json")
     inventory_item = InventoryItem()
     inventory_item.deserialize(request.get_json())
     inventory_item.create()
     message = inventory_item.serialize()
     location_url = url_for(
-        "get_inventory_item",
+        ".get_inventory_item",
         inventory_id=inventory_item.inventory_id,
         _external=True
     )
@@ -62,128 +106,694 @@ def create_new_inventory_item():
     )
 
 
+######################################################################
+# ADD MANY INVENTORY ITEMS
+######################################################################
+@api.route("/inventory/bulk", methods=["POST"])
+def bulk_create_inventory_items():
+    """
+    Creates many inventory items
+    This endpoint validates every item in the posted list and creates the valid
+    ones in a single transaction. With atomic=true nothing is created unless
+    every item is valid.
+    """
+    current_app.logger.info("Request to bulk create inventory items")
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, list):
+        raise DataValidationError("Invalid request: body must be a list of inventory items")
+    atomic = get_bool_arg("atomic")
+
+    inventory_items = []
+    errors = []
+    for index, entry in enumerate(data):
+        try:
+            inventory_items.append(InventoryItem().deserialize(entry))
+        except DataValidationError as error:
+            errors.append({"index": index, "message": str(error)})
+
+    if errors and (atomic or not inventory_items):
+        current_app.logger.warning("Rejected bulk create with %d invalid items", len(errors))
+        message = {"created": 0, "inventory_ids": [], "errors": errors}
+        return make_response(jsonify(message), status.HTTP_400_BAD_REQUEST)
+
+    inventory_ids = InventoryItem.bulk_create(inventory_items, current_app.config["BULK_BATCH_SIZE"])
+    current_app.logger.info("Bulk created %d inventory items", len(inventory_ids))
+    message = {"created": len(inventory_ids), "inventory_ids": inventory_ids, "errors": errors}
+    return make_response(jsonify(message), status.HTTP_201_CREATED)
+
+
+######################################################################
+# IMPORT INVENTORY ITEMS
+######################################################################
+@api.route("/inventory/import", methods=["POST"])
+def import_inventory_items():
+    """
+    Loads a CSV (text/csv) or NDJSON (application/x-ndjson) upload of inventory items
+    The upload is parsed as it is read and the valid rows are loaded in chunks
+    of IMPORT_BATCH_SIZE, each in its own transaction, so memory stays the same
+    for any size of file. Rejected rows are counted and the first
+    IMPORT_MAX_ERRORS of them are reported with their line number. If the
+    database refuses a chunk the import stops there, and the response says
+    how many rows the earlier chunks committed and which lines were rolled back
+    """
+    current_app.logger.info("Request to import inventory items")
+    content_type = request.headers.get("Content-Type", "").split(";")[0].strip()
+    if content_type == "text/csv":
+        records = read_csv_records(request.stream)
+    elif content_type == "application/x-ndjson":
+        records = read_ndjson_records(request.stream)
+    else:
+        abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+              "Content-Type must be text/csv or application/x-ndjson")
+    batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+    max_errors = current_app.config["IMPORT_MAX_ERRORS"]
+
+    imported = 0
+    rejected = 0
+    errors = []
+    chunk = []
+    lines = []
+    try:
+        for line, record in records:
+            try:
+                if not isinstance(record, dict):
+                    raise DataValidationError("Invalid InventoryItem: each line must be a JSON object")
+                chunk.append(InventoryItem().deserialize(record))
+                lines.append(line)
+            except DataValidationError as error:
+                rejected += 1
+                if len(errors) < max_errors:
+                    errors.append({"line": line, "message": str(error)})
+                continue
+            if len(chunk) == batch_size:
+                imported += InventoryItem.load(chunk)
+                chunk, lines = [], []
+        if chunk:
+            imported += InventoryItem.load(chunk)
+    except SQLAlchemyError as error:
+        # the earlier chunks are committed, so say how far the import got
+        reason = str(getattr(error, "orig", None) or error)
+        current_app.logger.error(
+            "Import failed on lines %d-%d after %d items: %s", lines[0], lines[-1], imported, reason
+        )
+        message = {
+            "imported": imported, "rejected": rejected, "errors": errors,
+            "failed": {"first_line": lines[0], "last_line": lines[-1], "message": reason},
+        }
+        return make_response(jsonify(message), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    current_app.logger.info("Imported %d inventory items and rejected %d", imported, rejected)
+    message = {"imported": imported, "rejected": rejected, "errors": errors}
+    code = status.HTTP_400_BAD_REQUEST if rejected and not imported else status.HTTP_201_CREATED
+    return make_response(jsonify(message), code)
+
+
 ######################################################################
 # LIST ALL INVENTORIES
 ######################################################################
-@app.route("/inventory", methods=["GET"])
+@api.route("/inventory", methods=["GET"])
 def list_inventory_items():
-    """ Returns all of the Inventory """
-    app.logger.info("Request for inventory list of all products")
-
-    all_inventory_items = []
-
-    supplier_name = request.args.get("supplier_name")
-    product_name = request.args.get("product_name")
-    supplier_id = request.args.get("supplier_id")
-    if supplier_name:
-        all_inventory_items = InventoryItem.find_by_supplier_name(supplier_name)
-    elif product_name:
-        all_inventory_items = InventoryItem.find_by_product_name(product_name)
-    elif supplier_id:
-        all_inventory_items = InventoryItem.find_by_supplier_id(supplier_id)
+    """
+    Returns all of the Inventory
+    Passing a limit and/or cursor returns a single page ordered by inventory id,
+    with a Link header pointing at the next page when there is one
+    Passing stream=1 or asking for application/x-ndjson streams every item instead
+    Any combination of column filters is supported, see InventoryItem.parse_filters
+    """
+    current_app.logger.info("Request for inventory list of all products")
+
+    limit = get_int_arg("limit", minimum=1)
+    cursor = get_int_arg("cursor", minimum=0)
+    filters = InventoryItem.parse_filters(request.args)
+
+    if get_bool_arg("stream") or wants_ndjson():
+        return stream_inventory_items(filters)
+
+    # a read-only listing, so plain rows are enough and much cheaper than InventoryItems
+    headers = {}
+    etag = None
+    if limit is None and cursor is None:
+        # the latest change sequence only moves when a write commits and is a
+        # primary key lookup; it is read before the rows so it is never newer
+        etag = make_etag(request.query_string.decode(), InventoryChange.latest_sequence())
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        with timed("fetch"):
+            rows = InventoryItem.find_rows(filters)
     else:
-        all_inventory_items = InventoryItem.all()
+        limit = min(limit or current_app.config["MAX_PAGE_SIZE"], current_app.config["MAX_PAGE_SIZE"])
+        # fetch one extra row to find out if there is a next page
+        with timed("fetch"):
+            rows = InventoryItem.find_rows(filters, limit + 1, cursor)
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1]["inventory_id"]
+            headers["Link"] = '<{}>; rel="next"'.format(next_page_url(limit, next_cursor))
+
+    with timed("serialize"):
+        results = [InventoryItem.serialize_row(row) for row in rows]
+        body = jsonify(results)
+
+    current_app.logger.info("Returning %d inventory items", len(results))
+    response = make_response(body, status.HTTP_200_OK, headers)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def stream_inventory_items(filters):
+    """ Streams inventory items as a JSON array or as NDJSON, one batch at a time """
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    ndjson = wants_ndjson()
+
+    def generate():
+        count = 0
+        batch = []
+        if not ndjson:
+            yield "["
+        for row in InventoryItem.stream_rows(filters, batch_size):
+            line = json.dumps(InventoryItem.serialize_row(row))
+            if ndjson:
+                batch.append(line + "\n")
+            else:
+                batch.append(line if count == 0 else "," + line)
+            count += 1
+            if len(batch) == batch_size:
+                yield "".join(batch)
+                batch = []
+        if not ndjson:
+            batch.append("]")
+        yield "".join(batch)
+        current_app.logger.info("Streamed %d inventory items", count)
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=mimetype)
+
+
+######################################################################
+# EXPORT INVENTORY ITEMS
+######################################################################
+@api.route("/inventory/export", methods=["GET"])
+def export_inventory_items():
+    """
+    Streams inventory items as CSV (the default) or NDJSON
+    The format comes from the Accept header, or format=csv|ndjson, and
+    columns= picks the columns; the filters are the same as the list's
+    Rows come from a server side cursor one batch at a time, so any size
+    of export uses the same memory and the first bytes go out right away
+    """
+    current_app.logger.info("Request to export inventory items")
+    filters = InventoryItem.parse_filters(request.args)
+    columns = InventoryItem.parse_columns(request.args.get("columns"))
+    export_format = request.args.get("format")
+    if export_format is None:
+        best = request.accept_mimetypes.best_match(["text/csv", "application/x-ndjson"])
+        export_format = "ndjson" if best == "application/x-ndjson" else "csv"
+    if export_format not in ("csv", "ndjson"):
+        raise DataValidationError("Invalid format: only csv and ndjson are supported")
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == "csv":
+            writer.writerow(columns)
+            yield drain(buffer)
+        count = 0
+        for row in InventoryItem.stream_rows(filters, batch_size, columns):
+            record = InventoryItem.serialize_columns(row, columns)
+            if export_format == "csv":
+                writer.writerow([record[name] for name in columns])
+            else:
+                buffer.write(json.dumps(record) + "\n")
+            count += 1
+            if count % batch_size == 0:
+                yield drain(buffer)
+        yield drain(buffer)
+        current_app.logger.info("Exported %d inventory items", count)
+
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "text/csv"
+    headers = {"Content-Disposition": "attachment; filename=inventory.{}".format(export_format)}
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, headers, mimetype=mimetype)
 
-    results = [inventory.serialize() for inventory in all_inventory_items]
 
-    app.logger.info("Returning %d inventory items", len(results))
+######################################################################
+# LIST INVENTORY ITEMS THAT NEED RESTOCKING
+######################################################################
+@api.route("/inventory/restock", methods=["GET"])
+def list_restock_items():
+    """
+    Returns the inventory items whose quantity is at or below their restock threshold
+    Accepts the same filters as the list, and group_by=supplier nests the
+    items under their supplier
+    """
+    current_app.logger.info("Request for inventory items that need restocking")
+    filters = InventoryItem.parse_filters(request.args)
+    rows = InventoryItem.find_restock(filters)
+    results = [InventoryItem.serialize_row(row) for row in rows]
+
+    group_by = request.args.get("group_by")
+    if group_by == "supplier":
+        grouped = []
+        for supplier_id, items in groupby(results, key=lambda item: item["supplier_id"]):
+            items = list(items)
+            grouped.append(
+                {"supplier_id": supplier_id, "supplier_name": items[0]["supplier_name"], "items": items}
+            )
+        results = grouped
+    elif group_by:
+        raise DataValidationError("Invalid group_by: only supplier is supported")
+
+    current_app.logger.info("Returning %d restock results", len(results))
     return make_response(jsonify(results), status.HTTP_200_OK)
 
 
+######################################################################
+# SUMMARIZE THE INVENTORY OF EVERY SUPPLIER
+######################################################################
+@api.route("/inventory/summary", methods=["GET"])
+def list_supplier_summaries():
+    """
+    Returns the item count, enabled count, total quantity and stock value of every supplier
+    The totals are kept up to date on every write; live=true computes them
+    from the inventory items instead
+    """
+    current_app.logger.info("Request for supplier summaries")
+    if get_bool_arg("live"):
+        results = InventoryItem.supplier_totals()
+    else:
+        results = [summary.serialize() for summary in SupplierSummary.all()]
+    current_app.logger.info("Returning %d supplier summaries", len(results))
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+
+######################################################################
+# FOLLOW THE CHANGES TO THE INVENTORY
+######################################################################
+@api.route("/inventory/changes", methods=["GET"])
+def list_inventory_changes():
+    """
+    Returns the changes to inventory items after a sequence number
+    When there are none yet the request waits up to wait= seconds (at most
+    CHANGES_MAX_WAIT) for one, so consumers can long poll with the
+    last_sequence of each response instead of re-reading the inventory.
+    A waiting request holds a server thread, so only CHANGES_MAX_WAITERS of
+    them (shared with the streams) wait at once and the others get 503
+    """
+    after = changes_after()
+    limit = min(get_int_arg("limit", minimum=1) or current_app.config["MAX_PAGE_SIZE"],
+                current_app.config["MAX_PAGE_SIZE"])
+    wait = min(get_int_arg("wait", minimum=0) or 0, current_app.config["CHANGES_MAX_WAIT"])
+    current_app.logger.info("Request for inventory changes after %s", after)
+    rows = InventoryChange.since(after, limit)
+    if not rows and wait:
+        waiters = current_app.extensions["inventory_change_waiters"]
+        if not waiters.acquire(blocking=False):
+            abort(status.HTTP_503_SERVICE_UNAVAILABLE, "Too many requests are waiting for changes")
+        try:
+            deadline = time.monotonic() + wait
+            while not rows and time.monotonic() < deadline:
+                # hand the connection back while waiting
+                db.session.rollback()
+                # the deadline can pass between the check and here
+                time.sleep(max(min(current_app.config["CHANGES_POLL_SECONDS"], deadline - time.monotonic()), 0))
+                rows = InventoryChange.since(after, limit)
+        finally:
+            waiters.release()
+    changes = [InventoryChange.serialize_row(row) for row in rows]
+    last_sequence = changes[-1]["sequence"] if changes else after
+    current_app.logger.info("Returning %d inventory changes", len(changes))
+    return make_response(jsonify(changes=changes, last_sequence=last_sequence), status.HTTP_200_OK)
+
+
+@api.route("/inventory/changes/stream", methods=["GET"])
+def stream_inventory_changes():
+    """
+    Streams the changes to inventory items as Server-Sent Events
+    Each event has the change's sequence as its id, so a client that
+    reconnects with Last-Event-ID carries on where it left off. The stream
+    ends after CHANGES_STREAM_SECONDS and the client reconnects. A stream
+    holds a server thread, so only CHANGES_MAX_WAITERS of them (shared with
+    the long polls) run at once and the others get 503
+    """
+    after = changes_after()
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    poll_seconds = current_app.config["CHANGES_POLL_SECONDS"]
+    stream_seconds = current_app.config["CHANGES_STREAM_SECONDS"]
+    if request.args.get("wait") is not None:
+        stream_seconds = min(get_int_arg("wait", minimum=0), stream_seconds)
+    current_app.logger.info("Request to stream inventory changes after %s", after)
+    waiters = current_app.extensions["inventory_change_waiters"]
+    if not waiters.acquire(blocking=False):
+        abort(status.HTTP_503_SERVICE_UNAVAILABLE, "Too many requests are waiting for changes")
+
+    def generate():
+        last = after
+        count = 0
+        started = quiet_since = time.monotonic()
+        yield "retry: {}\n\n".format(int(poll_seconds * 1000))
+        while True:
+            rows = InventoryChange.since(last, batch_size)
+            # hand the connection back between polls
+            db.session.rollback()
+            for row in rows:
+                change = InventoryChange.serialize_row(row)
+                last = change["sequence"]
+                yield "id: {}\nevent: {}\ndata: {}\n\n".format(last, change["operation"], json.dumps(change))
+            count += len(rows)
+            now = time.monotonic()
+            if len(rows) == batch_size:
+                continue
+            if now - started >= stream_seconds:
+                break
+            if rows:
+                quiet_since = now
+            elif now - quiet_since >= KEEPALIVE_SECONDS:
+                # a comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                quiet_since = now
+            time.sleep(min(poll_seconds, stream_seconds - (now - started)))
+        current_app.logger.info("Streamed %d inventory changes", count)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(stream_with_context(generate()), status.HTTP_200_OK, headers, mimetype="text/event-stream")
+    # released when the server closes the response, even if the client went away first
+    response.call_on_close(waiters.release)
+    return response
+
+
 ######################################################################
 # RETRIEVE AN INVENTORY ITEM
 ######################################################################
-@app.route("/inventory/<int:inventory_id>", methods=["GET"])
+@api.route("/inventory/<int:inventory_id>", methods=["GET"])
 def get_inventory_item(inventory_id):
     """
     Retrieve a single inventory item
     This endpoint will return an inventory item based on it's id
     """
-    app.logger.info("Request for inventory item with id: %s", inventory_id)
-    inventory_item = InventoryItem.find(inventory_id)
+    current_app.logger.info("Request for inventory item with id: %s", inventory_id)
+    with timed("fetch"):
+        inventory_item = InventoryItem.find_serialized(inventory_id)
     if not inventory_item:
         raise NotFound("Inventory item with inventory id '{}' was not found.".format(inventory_id))
-    return make_response(jsonify(inventory_item.serialize()), status.HTTP_200_OK)
+    etag = item_etag(inventory_item)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    response = make_response(jsonify(inventory_item), status.HTTP_200_OK)
+    response.set_etag(etag)
+    return response
 
 
 ######################################################################
 # UPDATE AN EXISTING INVENTORY ITEM
 ######################################################################
-@app.route("/inventory/<int:inventory_id>", methods=["PUT"])
+@api.route("/inventory/<int:inventory_id>", methods=["PUT"])
 def update_inventory_item(inventory_id):
     """
     Update an inventory item
     This endpoint will update an inventory item based the body that is posted
+    The update only applies to the version the client read: send the ETag in
+    If-Match (412 on mismatch) or the version in the body (409 on mismatch)
     """
-    app.logger.info("Request to update Inventory item with id: %s", inventory_id)
+    current_app.logger.info("Request to update Inventory item with id: %s", inventory_id)
     check_content_type("application/json")
     inventory_item = InventoryItem.find(inventory_id)
     if not inventory_item:
         raise NotFound("Inventory item with id '{}' was not found.".format(inventory_id))
+    if request.if_match and item_etag(inventory_item.serialize()) not in request.if_match:
+        abort(status.HTTP_412_PRECONDITION_FAILED,
+              "Inventory item with id '{}' has changed.".format(inventory_id))
     inventory_item.deserialize(request.get_json())
     inventory_item.inventory_id = inventory_id
-    inventory_item.save()
-    return make_response(jsonify(inventory_item.serialize()), status.HTTP_200_OK)
+    try:
+        inventory_item.save()
+    except VersionConflictError as error:
+        # someone else committed between our read and our write
+        if request.if_match:
+            abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
+        raise
+    message = inventory_item.serialize()
+    response = make_response(jsonify(message), status.HTTP_200_OK)
+    response.set_etag(item_etag(message))
+    return response
+
+
+######################################################################
+# ADJUST THE QUANTITY OF AN INVENTORY ITEM
+######################################################################
+@api.route("/inventory/<int:inventory_id>/quantity", methods=["PATCH"])
+def adjust_inventory_quantity(inventory_id):
+    """
+    Adjust the quantity of an inventory item
+    This endpoint adds the signed delta in the body, e.g. {"delta": -3}, to the
+    quantity in one UPDATE statement and returns the new quantity.
+    With COALESCE_WRITES on the delta is queued and written with the others
+    of its flush; the response waits for the flush unless wait=false is
+    given, and is 202 Accepted if the change is not written yet
+    """
+    current_app.logger.info("Request to adjust quantity of inventory item with id: %s", inventory_id)
+    check_content_type("application/json")
+    data = request.get_json()
+    delta = data.get("delta") if isinstance(data, dict) else None
+    if not isinstance(delta, int) or isinstance(delta, bool):
+        raise DataValidationError("Invalid quantity change: body must contain an integer delta")
+    if not INTEGER_MIN <= delta <= INTEGER_MAX:
+        raise DataValidationError(
+            "Invalid quantity change: delta must be between {} and {}".format(INTEGER_MIN, INTEGER_MAX)
+        )
+    coalescer = current_app.extensions.get("inventory_coalescer")
+    if coalescer is None:
+        result = InventoryItem.adjust_quantity(inventory_id, delta)
+    else:
+        ticket = coalescer.submit(inventory_id, delta)
+        wait = get_bool_arg("wait", default=True)
+        if not wait or not ticket.wait(coalescer.ack_timeout):
+            return make_response(
+                jsonify(inventory_id=inventory_id, delta=delta, status="queued"), status.HTTP_202_ACCEPTED
+            )
+        result = ticket.result()
+    if not result:
+        raise NotFound("Inventory item with id '{}' was not found.".format(inventory_id))
+    return make_response(jsonify(result), status.HTTP_200_OK)
 
 
 ######################################################################
 # DELETE AN INVENTORY ITEM
 ######################################################################
-@app.route("/inventory/<int:inventory_id>", methods=["DELETE"])
+@api.route("/inventory/<int:inventory_id>", methods=["DELETE"])
 def delete_inventory_item(inventory_id):
     """
     Delete an inventory item
     This endpoint will delete an inventory item based the inventory id specified in the path
     """
-    app.logger.info("Request to delete inventory item with id: %s", inventory_id)
+    current_app.logger.info("Request to delete inventory item with id: %s", inventory_id)
     inventory_item = InventoryItem.find(inventory_id)
     if inventory_item:
         inventory_item.delete()
     return make_response("", status.HTTP_204_NO_CONTENT)
 
 
+######################################################################
+# DELETE INVENTORY ITEMS BY FILTER
+######################################################################
+@api.route("/inventory", methods=["DELETE"])
+def delete_inventory_items():
+    """
+    Delete every inventory item matching the filters of the list route
+    The items are removed with a single DELETE in one transaction.
+    dry_run=true only counts them, and deleting without any filter
+    needs confirm=true
+    """
+    current_app.logger.info("Request to delete inventory items by filter")
+    filters = InventoryItem.parse_filters(request.args, others=("dry_run", "confirm"))
+    if get_bool_arg("dry_run"):
+        matched = InventoryItem.count_by_filters(filters)
+        return make_response(jsonify(matched=matched, deleted=0), status.HTTP_200_OK)
+    if not filters and not get_bool_arg("confirm"):
+        raise DataValidationError("Deleting every inventory item needs confirm=true")
+    deleted = InventoryItem.delete_by_filters(filters)
+    current_app.logger.info("Deleted %d inventory items", deleted)
+    return make_response(jsonify(matched=deleted, deleted=deleted), status.HTTP_200_OK)
+
+
 ######################################################################
 # DISABLE ITEM BY SUPPLIER ID
 ######################################################################
-@app.route("/inventory/supplier/<int:supplier_id>", methods=["PUT"])
+@api.route("/inventory/supplier/<int:supplier_id>", methods=["PUT"])
 def disable_supplier(supplier_id):
     """
     Toggle inventory item status to enabled or disabled given Supplier ID
     This endpoint will enable or disable an inventory item based the supplier id specified in the path
     """
-    app.logger.info("Request to disable inventory item with supplier id: %s", supplier_id)
+    current_app.logger.info("Request to disable inventory item with supplier id: %s", supplier_id)
 
-    # retrieve inventory items from DB based on supplier id
-    inventory_items = InventoryItem.find_by_supplier_id(supplier_id)
-    if not inventory_items or inventory_items.count() == 0:
+    # toggle every item of the supplier with a single UPDATE
+    results = InventoryItem.toggle_supplier_status(supplier_id)
+    if not results:
         raise NotFound("Inventory items with supplier id '{}' were not found.".format(supplier_id))
 
-    results = []
-    for item in inventory_items:
-        # toggle supplier status attribute on item
-        item.supplier_status = "disabled" if item.supplier_status == "enabled" else "enabled"
+    current_app.logger.info("Toggled supplier status of %d inventory items", len(results))
+    return make_response(jsonify(results), status.HTTP_200_OK)
 
-        # save item in DB and return new item
-        item.save()
-        results.append(item.serialize())
 
-    return make_response(jsonify(results), status.HTTP_200_OK)
+######################################################################
+# REPORT THE DATABASE CONNECTION POOL
+######################################################################
+@api.route("/internal/pool", methods=["GET"])
+def get_pool_stats():
+    """
+    Returns the live state of this worker's database connection pool
+    The checked out and overflow counts and the wait times show whether
+    the DB_POOL_* settings are too small for the load
+    """
+    current_app.logger.info("Request for connection pool stats")
+    stats = pool_stats(db.engine)
+    replica_set = current_app.extensions.get("inventory_replicas")
+    if replica_set is not None:
+        stats["replicas"] = [
+            dict(pool_stats(engine), host=engine.url.host, healthy=replica_set.healthy(engine))
+            for engine in replica_set.engines
+        ]
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+
+######################################################################
+# REPORT METRICS
+######################################################################
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Returns the request, SQL statement and error metrics in the Prometheus
+    text format: of every worker with METRICS_DIR set, else of this one
+    """
+    store = current_app.extensions.get("inventory_metrics_store")
+    return Response(metrics.render(store), mimetype=metrics.CONTENT_TYPE)
 
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
-def init_db():
-    """ Initializes the SQLAlchemy app """
-    global app
-    InventoryItem.init_db(app)
+def get_int_arg(name, minimum=None):
+    """ Returns an integer query parameter, or None when it is not present """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "{} must be an integer".format(name))
+    if minimum is not None and number < minimum:
+        abort(status.HTTP_400_BAD_REQUEST, "{} must be at least {}".format(name, minimum))
+    return number
+
+
+def get_bool_arg(name, default=False):
+    """ Returns a true/false query parameter, or the default when it is not present """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if value.lower() in ("1", "true", "yes"):
+        return True
+    if value.lower() in ("0", "false", "no"):
+        return False
+    abort(status.HTTP_400_BAD_REQUEST, "{} must be true or false".format(name))
+
+
+def changes_after():
+    """
+    Returns the sequence to follow the changes after, from Last-Event-ID or after=
+
+    Aborts with 410 Gone when changes after it have already been pruned, as
+    the client has to re-read the inventory instead
+    """
+    value = request.headers.get("Last-Event-ID")
+    if value is None:
+        after = get_int_arg("after", minimum=0) or 0
+    elif not value.isdigit():
+        abort(status.HTTP_400_BAD_REQUEST, "Last-Event-ID must be a change sequence")
+    else:
+        after = int(value)
+    # pruning always keeps the latest change, so oldest is only None before the first one
+    oldest = InventoryChange.oldest_sequence()
+    if after and oldest is not None and after < oldest - 1:
+        abort(status.HTTP_410_GONE, "Changes after {} are no longer kept, the oldest is {}".format(after, oldest))
+    return after
+
+
+def next_page_url(limit, cursor):
+    """ Builds the URL of the next page keeping every other query parameter """
+    # every value, so a repeated (IN-list) filter carries over to the next page
+    args = request.args.to_dict(flat=False)
+    args["limit"] = limit
+    args["cursor"] = cursor
+    return url_for(".list_inventory_items", _external=True, **args)
+
+
+def wants_ndjson():
+    """ Returns True when the client prefers newline delimited JSON """
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+def read_csv_records(stream):
+    """ Yields the line number and fields of each row of a CSV upload with a header """
+    reader = csv.DictReader(line.decode("utf-8") for line in stream)
+    nullable = {column.name for column in InventoryItem.__table__.columns if column.nullable}
+    for record in reader:
+        # CSV cannot tell an empty value from a missing one
+        yield reader.line_num, {
+            name: None if value == "" and name in nullable else value for name, value in record.items()
+        }
+
+
+def read_ndjson_records(stream):
+    """ Yields the line number and object of each line of an NDJSON upload """
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line.decode("utf-8"))
+        except ValueError:
+            yield number, None
+
+
+def drain(buffer):
+    """ Returns the text written to a StringIO and empties it """
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+def make_etag(*parts):
+    """ Builds a strong ETag from the values that identify a representation """
+    return hashlib.md5("|".join(str(part) for part in parts).encode("utf8")).hexdigest()
+
+
+def item_etag(data):
+    """
+    Builds the ETag of a serialized inventory item from its version
+
+    updated_at is part of it too, as an id can be reused after a delete and
+    the new item starts at version 1 again
+    """
+    return make_etag(data["inventory_id"], data.get("version"), data.get("updated_at"))
+
+
+def not_modified(etag):
+    """ Answers a conditional GET whose ETag still matches """
+    current_app.logger.info("Returning 304 for ETag %s", etag)
+    response = make_response("", status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(etag)
+    return response
 
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
         return
-    app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
+    current_app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(415, "Content-Type must be {}".format(content_type))
 
 
@@ -191,17 +801,18 @@ def check_content_type(content_type):
 # ERROR HANDLERS
 ######################################################################
 
-@app.errorhandler(DataValidationError)
+@api.app_errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles Value Errors from bad data """
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
+@api.app_errorhandler(status.HTTP_400_BAD_REQUEST)
+@metrics.counted_error
 def bad_request(error):
     """ Handles bad requests with 400_BAD_REQUEST """
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message
@@ -210,22 +821,24 @@ def bad_request(error):
     )
 
 
-@app.errorhandler(status.HTTP_404_NOT_FOUND)
+@api.app_errorhandler(status.HTTP_404_NOT_FOUND)
+@metrics.counted_error
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(status=status.HTTP_404_NOT_FOUND, error="Not Found", message=message),
         status.HTTP_404_NOT_FOUND,
     )
 
 
-@app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@api.app_errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
+@metrics.counted_error
 def method_not_supported(error):
     """ Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED """
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_405_METHOD_NOT_ALLOWED,
@@ -236,11 +849,64 @@ def method_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@api.app_errorhandler(VersionConflictError)
+def request_conflict_error(error):
+    """ Handles updates of inventory items that changed since they were read """
+    return conflict(error)
+
+
+@api.app_errorhandler(InsufficientQuantityError)
+def request_quantity_error(error):
+    """ Handles quantity changes that would leave negative stock """
+    return conflict(error)
+
+
+@api.app_errorhandler(status.HTTP_409_CONFLICT)
+@metrics.counted_error
+def conflict(error):
+    """ Handles conflicting changes with 409_CONFLICT """
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
+@api.app_errorhandler(status.HTTP_410_GONE)
+@metrics.counted_error
+def gone(error):
+    """ Handles resources that are no longer kept with 410_GONE """
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_410_GONE, error="Gone", message=message),
+        status.HTTP_410_GONE,
+    )
+
+
+@api.app_errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+@metrics.counted_error
+def precondition_failed(error):
+    """ Handles failed If-Match preconditions with 412_PRECONDITION_FAILED """
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+
+@api.app_errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+@metrics.counted_error
 def mediatype_not_supported(error):
     """ Handles unsupported media requests with 415_UNSUPPORTED_MEDIA_TYPE """
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
@@ -251,11 +917,25 @@ def mediatype_not_supported(error):
     )
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@api.app_errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+@metrics.counted_error
+def service_unavailable(error):
+    """ Handles requests turned away while the service is busy with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE, error="Service Unavailable", message=message),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+
+@api.app_errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+@metrics.counted_error
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
     message = str(error)
-    app.logger.error(message)
+    current_app.logger.error(message)
     return (
         jsonify(
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
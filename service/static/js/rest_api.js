@@ -242,13 +242,12 @@ $(function () {
     // ****************************************
 
     $("#search-btn").click(function () {
-        // FIXME: We dont support searching by most of these fields so those will not work. see ../../models.py to either make more search methods or determine which to remove below
+        // supplier_status is left out because the dropdown always has a value
         const inventory_id = $("#inventory_id").val();
         const product_id = $("#product_id").val();
-        const product_name = $("#product_name").val(); //supported
-        const supplier_id = $("#supplier_id").val(); //supported
-        const supplier_name = $("#supplier_name").val(); //supported
-        const supplier_status = $("#supplier_status").val();
+        const product_name = $("#product_name").val();
+        const supplier_id = $("#supplier_id").val();
+        const supplier_name = $("#supplier_name").val();
 
         let queryString = "";
 
@@ -269,13 +268,6 @@ $(function () {
                 queryString += 'supplier_id=' + supplier_id
             }
         }
-        if (supplier_status) {
-            if (queryString.length > 0) {
-                queryString += '&supplier_status=' + supplier_status
-            } else {
-                queryString += 'supplier_status=' + supplier_status
-            }
-        }
         if (inventory_id) {
             if (queryString.length > 0) {
                 queryString += '&inventory_id=' + inventory_id
@@ -0,0 +1,51 @@
+"""
+Test cases for the HTTP Load Benchmark helpers
+
+"""
+import unittest
+
+from benchmarks.http_load import SCENARIOS, Context, compare, import_range, make_csv, percentile
+
+
+######################################################################
+#  B E N C H M A R K   T E S T   C A S E S
+######################################################################
+class TestHttpLoad(unittest.TestCase):
+    """ Test Cases for the benchmark statistics """
+
+    def test_percentile(self):
+        """ Pick the nearest-rank percentile """
+        values = [float(n) for n in range(1, 101)]
+        self.assertEqual(percentile(values, 0.50), 50.0)
+        self.assertEqual(percentile(values, 0.95), 95.0)
+        self.assertEqual(percentile(values, 0.99), 99.0)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+    def test_compare(self):
+        """ Flag routes that got slower or served fewer requests """
+        baseline = {
+            "get": {"p95_ms": 10.0, "throughput": 100.0},
+            "list_all": {"p95_ms": 10.0, "throughput": 100.0},
+            "summary": {"p95_ms": 10.0, "throughput": 100.0},
+        }
+        results = {
+            "get": {"p95_ms": 11.0, "throughput": 95.0},
+            "list_all": {"p95_ms": 13.0, "throughput": 100.0},
+            "summary": {"p95_ms": 10.0, "throughput": 70.0},
+            "metrics": {"p95_ms": 50.0, "throughput": 1.0},
+        }
+        self.assertEqual(compare(baseline, results, 0.2), ["list_all", "summary"])
+
+    def test_scenarios(self):
+        """ Build a request for every scenario, imports as CSV uploads """
+        context = Context([1, 2, 3], [4], 1)
+        for name, make_request, expected in SCENARIOS:
+            method, path, body = make_request(context, 5)
+            self.assertTrue(path.startswith("/"), name)
+            self.assertTrue(expected, name)
+        scenarios = {name: make_request for name, make_request, _ in SCENARIOS}
+        upload = scenarios["import"](context, 5)[2]
+        lines = upload.splitlines()
+        self.assertTrue(lines[0].startswith("product_id,product_name,"))
+        self.assertEqual(len(lines), 1 + import_range(5)[1] - import_range(5)[0])
+        self.assertEqual(make_csv([{"a": 1, "b": None}]), "a,b\r\n1,\r\n")
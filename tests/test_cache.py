@@ -0,0 +1,118 @@
+"""
+Test cases for the Item Cache
+
+"""
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from flask import Flask
+
+from service.cache import MemoryCache, RedisCache, NullCache, ItemCache
+
+
+class FakeRedis():
+    """ A local stand-in for a Redis client """
+
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None or value[1] <= time.monotonic():
+            return None
+        return value[0]
+
+    def set(self, key, value, ex=None):
+        self.store[key] = (value.encode(), time.monotonic() + ex)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.store.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in self.store if key.startswith(match.rstrip("*"))]
+
+
+######################################################################
+#  I T E M   C A C H E   T E S T   C A S E S
+######################################################################
+class TestItemCache(unittest.TestCase):
+    """ Test Cases for the Item Cache backends """
+
+    def test_memory_cache_get_and_set(self):
+        """ Store and read back a value """
+        cache = MemoryCache(max_size=10, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"inventory_id": 1})
+        self.assertEqual(cache.get(1), {"inventory_id": 1})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_memory_cache_evicts_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        cache = MemoryCache(max_size=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)  # 2 is now the least recently used
+        cache.set(3, "three")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(1), "one")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), "three")
+
+    def test_memory_cache_expires(self):
+        """ Expire values after the TTL """
+        cache = MemoryCache(max_size=10, ttl=60)
+        cache.set(1, "one")
+        with patch("service.cache.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get(1))
+        self.assertEqual(len(cache), 0)
+
+    def test_redis_cache(self):
+        """ Store values in a shared store """
+        client = FakeRedis()
+        cache = RedisCache(client, ttl=60)
+        cache.set(1, {"inventory_id": 1})
+        cache.set(2, {"inventory_id": 2})
+        self.assertEqual(cache.get(1), {"inventory_id": 1})
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+        cache.clear()
+        self.assertEqual(client.store, {})
+
+    def test_item_cache_backends(self):
+        """ Pick the backend of each app from its configuration """
+        cache = ItemCache()
+        self.assertIsInstance(cache.backend, NullCache)
+        memory_app = Flask(__name__)
+        memory_app.config.update(CACHE_BACKEND="memory", CACHE_MAX_SIZE=5)
+        cache.init_app(memory_app)
+        redis_app = Flask(__name__)
+        cache.init_app(redis_app, backend=RedisCache(FakeRedis()))
+        # a second app leaves the first one's backend alone
+        with memory_app.app_context():
+            self.assertIsInstance(cache.backend, MemoryCache)
+            self.assertEqual(cache.backend.max_size, 5)
+        with redis_app.app_context():
+            self.assertIsInstance(cache.backend, RedisCache)
+        with Flask(__name__).app_context():
+            self.assertIsInstance(cache.backend, NullCache)
+
+    def test_item_cache_fails_open(self):
+        """ Miss instead of failing when the backend is down """
+        backend = Mock()
+        backend.get.side_effect = ConnectionError("down")
+        backend.set.side_effect = ConnectionError("down")
+        backend.delete.side_effect = ConnectionError("down")
+        backend.clear.side_effect = ConnectionError("down")
+        cache = ItemCache()
+        app = Flask(__name__)
+        cache.init_app(app, backend=backend)
+        with app.app_context():
+            self.assertIsNone(cache.get(1))
+            cache.set(1, "one")
+            # writes have committed by the time they invalidate, so that must not raise either
+            cache.invalidate(1, 2)
+            cache.clear()
+        backend.delete.assert_called_once_with(1, 2)
@@ -0,0 +1,73 @@
+"""
+Test cases for the Metrics
+
+"""
+import json
+import os
+import tempfile
+import unittest
+
+from service.metrics import Counter, Histogram, DirectoryStore, REQUESTS, STATEMENT_DURATION, render
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the Counter, Histogram and DirectoryStore """
+
+    def test_counter(self):
+        """ Count by label values and render them """
+        counter = Counter("test_total", "A test counter", ("route",))
+        counter.inc("/a")
+        counter.inc("/a")
+        counter.inc('/"b"', amount=3)
+        self.assertEqual(counter.value("/a"), 2)
+        self.assertEqual(counter.render(), [
+            "# HELP test_total A test counter",
+            "# TYPE test_total counter",
+            'test_total{route="/\\"b\\""} 3',
+            'test_total{route="/a"} 2',
+        ])
+
+    def test_histogram(self):
+        """ Sort values into cumulative buckets """
+        histogram = Histogram("test_seconds", "A test histogram", ("route",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "/a")
+        histogram.observe(0.1, "/a")
+        histogram.observe(5.0, "/a")
+        self.assertEqual(histogram.count("/a"), 3)
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{route="/a",le="0.1"} 2',
+            'test_seconds_bucket{route="/a",le="1.0"} 2',
+            'test_seconds_bucket{route="/a",le="+Inf"} 3',
+            'test_seconds_sum{route="/a"} 5.15',
+            'test_seconds_count{route="/a"} 3',
+        ])
+
+    def test_directory_store(self):
+        """ Add up the metrics that every process wrote to the directory """
+        path = tempfile.mkdtemp()
+        store = DirectoryStore(path, interval=3600)
+        REQUESTS.inc("/store", "GET", "200", amount=2)
+        STATEMENT_DURATION.observe(0.01, "STORE")
+        # what another worker wrote
+        with open(os.path.join(path, "metrics-1.json"), "w") as file:
+            json.dump({
+                REQUESTS.name: [[["/store", "GET", "200"], 3]],
+                STATEMENT_DURATION.name: [[["STORE"], [[0] * len(STATEMENT_DURATION.buckets), 0.5]]],
+            }, file)
+        lines = render(store).splitlines()
+        self.assertIn('inventory_http_requests_total{route="/store",method="GET",status="200"} 5', lines)
+        self.assertIn('inventory_db_statement_duration_seconds_sum{operation="STORE"} 0.51', lines)
+        self.assertIn("metrics-{}.json".format(os.getpid()), os.listdir(path))
+        store.clear()
+        self.assertEqual(os.listdir(path), [])
+
+    def test_forked_worker(self):
+        """ Forget the counts a worker inherited from the master """
+        store = DirectoryStore(tempfile.mkdtemp(), interval=3600)
+        REQUESTS.inc("/forked", "GET", "200")
+        store._created_pid = -1  # as if made in the master before the fork
+        store.start()
+        self.assertEqual(REQUESTS.value("/forked", "GET", "200"), 0)
@@ -5,11 +5,18 @@ Test cases for InventoryItem Model
 import logging
 import unittest
 import os
+from datetime import datetime, timedelta
 
 from flask_api import status
+from sqlalchemy import inspect
+from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import NotFound
 
-from service.models import InventoryItem, DataValidationError, db
+from service.cache import item_cache, MemoryCache, NullCache
+from service.models import (
+    InventoryItem, InventoryChange, SupplierSummary, DataValidationError, VersionConflictError,
+    InsufficientQuantityError, db
+)
 from service import app
 
 DATABASE_URI = os.getenv(
@@ -85,6 +92,20 @@ class TestInventoryItem(unittest.TestCase):
         test_item = InventoryItem.all()
         self.assertEqual(len(test_item), 1)
 
+    def test_bulk_create_inventory_items(self):
+        """ Create many inventory items in one transaction """
+        test_items = [
+            _create_test_inventory_item(
+                product_id=i, product_name="test product", quantity=100, restock_threshold=50,
+                supplier_name="test supplier", supplier_id=123, unit_price=12.50, supplier_status="enabled")
+            for i in range(5)]
+        inventory_ids = InventoryItem.bulk_create(test_items, 2)
+        self.assertEqual(len(inventory_ids), 5)
+        found_items = InventoryItem.all()
+        self.assertEqual(sorted(item.inventory_id for item in found_items), sorted(inventory_ids))
+        for inventory_id, test_item in zip(inventory_ids, test_items):
+            self.assertEqual(InventoryItem.find(inventory_id).product_id, test_item.product_id)
+
     def test_find_inventory_item(self):
         """ Find an inventory item by ID """
         test_items = self._create_test_inventory_items(3)
@@ -189,6 +210,98 @@ class TestInventoryItem(unittest.TestCase):
 
         self.assertEqual(found_items, matches)
 
+    def test_find_rows(self):
+        """ Find plain rows that serialize like the inventory items """
+        test_items = self._create_test_inventory_items(5)
+        test_items[3].quantity = 10
+        test_items[3].save()
+        filters = [("quantity", "gte", 50)]
+        expected = [item.serialize() for item in test_items if item.quantity >= 50]
+        rows = InventoryItem.find_rows(filters)
+        self.assertEqual([InventoryItem.serialize_row(row) for row in rows], expected)
+        rows = InventoryItem.find_rows(filters, 2, test_items[0].inventory_id)
+        self.assertEqual([row["inventory_id"] for row in rows],
+                         [test_items[1].inventory_id, test_items[2].inventory_id])
+        rows = InventoryItem.stream_rows(filters, 2)
+        self.assertEqual([InventoryItem.serialize_row(row) for row in rows], expected)
+        # keyset pages after a cursor
+        rows = InventoryItem.find_rows([], 2, test_items[3].inventory_id)
+        self.assertEqual([row["inventory_id"] for row in rows], [test_items[4].inventory_id])
+
+    def test_toggle_supplier_status(self):
+        """ Toggle the supplier status of every item from a supplier """
+        inventory_items = [
+            _create_test_inventory_item(
+                product_id=123, product_name="test product", quantity=100, restock_threshold=50,
+                supplier_name="test supplier1", supplier_id=123, unit_price=12.50, supplier_status="enabled"),
+            _create_test_inventory_item(
+                product_id=124, product_name="test product2", quantity=100, restock_threshold=50,
+                supplier_name="test supplier1", supplier_id=123, unit_price=12.50, supplier_status="disabled"),
+            _create_test_inventory_item(
+                product_id=125, product_name="test product3", quantity=100, restock_threshold=50,
+                supplier_name="test supplier2", supplier_id=125, unit_price=12.50, supplier_status="enabled")]
+        for inventory_item in inventory_items:
+            inventory_item.create()
+
+        results = InventoryItem.toggle_supplier_status(123)
+        self.assertEqual([item["inventory_id"] for item in results],
+                         [inventory_items[0].inventory_id, inventory_items[1].inventory_id])
+        self.assertEqual([item["supplier_status"] for item in results], ["disabled", "enabled"])
+        self.assertEqual(InventoryItem.find(inventory_items[0].inventory_id).supplier_status, "disabled")
+        self.assertEqual(InventoryItem.find(inventory_items[1].inventory_id).supplier_status, "enabled")
+        # other suppliers are left alone
+        self.assertEqual(InventoryItem.find(inventory_items[2].inventory_id).supplier_status, "enabled")
+        self.assertEqual(InventoryItem.toggle_supplier_status(999), [])
+
+    def test_parse_filters(self):
+        """ Parse filters from query parameters """
+        args = MultiDict([
+            ("supplier_id", "123"), ("supplier_id", "125"), ("product_name", "test product"),
+            ("quantity_gte", "10"), ("unit_price_lt", "20.5"), ("supplier_name", ""),
+            ("limit", "10"), ("supplier_status_gt", "enabled"),
+        ])
+        filters = InventoryItem.parse_filters(args)
+        self.assertEqual(filters, [
+            ("product_name", "eq", "test product"),
+            ("quantity", "gte", 10),
+            ("supplier_id", "in", [123, 125]),
+            ("unit_price", "lt", 20.5),
+        ])
+        self.assertRaises(DataValidationError, InventoryItem.parse_filters, MultiDict([("quantity_lt", "many")]))
+
+    def test_find_rows_by_filters(self):
+        """ Find inventory items matching a combination of filters """
+        inventory_items = [
+            _create_test_inventory_item(
+                product_id=123, product_name="test product", quantity=5, restock_threshold=50,
+                supplier_name="test supplier1", supplier_id=123, unit_price=10.00, supplier_status="enabled"),
+            _create_test_inventory_item(
+                product_id=124, product_name="test product2", quantity=50, restock_threshold=50,
+                supplier_name="test supplier2", supplier_id=125, unit_price=20.00, supplier_status="enabled"),
+            _create_test_inventory_item(
+                product_id=125, product_name="test product3", quantity=500, restock_threshold=50,
+                supplier_name="test supplier2", supplier_id=125, unit_price=30.00, supplier_status="disabled"),
+            _create_test_inventory_item(
+                product_id=127, product_name="test product4", quantity=50, restock_threshold=50,
+                supplier_name="test supplier3", supplier_id=127, unit_price=40.00, supplier_status="enabled")]
+        for inventory_item in inventory_items:
+            inventory_item.create()
+
+        def found(filters):
+            return [row["product_id"] for row in InventoryItem.find_rows(filters)]
+
+        self.assertEqual(found([]), [123, 124, 125, 127])
+        self.assertEqual(found([("supplier_id", "eq", 125), ("supplier_status", "eq", "enabled")]), [124])
+        self.assertEqual(found([("supplier_id", "in", [123, 127])]), [123, 127])
+        self.assertEqual(found([("quantity", "gte", 50), ("quantity", "lt", 500)]), [124, 127])
+        self.assertEqual(found([("unit_price", "gt", 10.0), ("unit_price", "lte", 30.0)]), [124, 125])
+        # the same shape with different values reuses the select and its compiled SQL
+        selects, compiled = len(InventoryItem._selects), len(InventoryItem._compiled)
+        self.assertEqual(found([("supplier_id", "in", [125])]), [124, 125])
+        self.assertEqual(found([("supplier_id", "in", [123, 125, 127])]), [123, 124, 125, 127])
+        self.assertEqual((len(InventoryItem._selects), len(InventoryItem._compiled)), (selects, compiled))
+        self.assertEqual(found([("supplier_id", "eq", 999)]), [])
+
     def test_update_a_inventory_item(self):
         """ Update an inventory item """
         test_item = self._create_test_inventory_items(1)[0]
@@ -208,6 +321,57 @@ class TestInventoryItem(unittest.TestCase):
         self.assertEqual(found_items[0].inventory_id, 1)
         self.assertEqual(found_items[0].supplier_name, "new supplier")
 
+    def test_update_bumps_version(self):
+        """ Bump the version of an inventory item on every update """
+        test_item = self._create_test_inventory_items(1)[0]
+        self.assertEqual(test_item.version, 1)
+        test_item.quantity = 5
+        test_item.save()
+        self.assertEqual(InventoryItem.find(test_item.inventory_id).version, 2)
+        InventoryItem.toggle_supplier_status(test_item.supplier_id)
+        self.assertEqual(InventoryItem.find(test_item.inventory_id).version, 3)
+
+    def test_update_a_stale_inventory_item(self):
+        """ Refuse to overwrite an inventory item changed by someone else """
+        test_item = self._create_test_inventory_items(1)[0]
+        test_item = InventoryItem.find(test_item.inventory_id)
+        # another writer commits a change after we read the item
+        table = InventoryItem.__table__
+        db.session.execute(table.update().values(quantity=1, version=table.c.version + 1))
+        test_item.quantity = 5
+        self.assertRaises(VersionConflictError, test_item.save)
+        found_item = InventoryItem.find(test_item.inventory_id)
+        self.assertEqual(found_item.version, 1)
+        self.assertEqual(found_item.quantity, 100)
+
+    def test_adjust_quantity(self):
+        """ Add a signed delta to the quantity of an inventory item """
+        test_item = self._create_test_inventory_items(1)[0]
+        result = InventoryItem.adjust_quantity(test_item.inventory_id, -30)
+        self.assertEqual(result, {"inventory_id": test_item.inventory_id, "quantity": 70, "version": 2})
+        result = InventoryItem.adjust_quantity(test_item.inventory_id, 5)
+        self.assertEqual(result["quantity"], 75)
+        self.assertEqual(InventoryItem.find(test_item.inventory_id).quantity, 75)
+        # stock can go down to zero but not below
+        self.assertRaises(InsufficientQuantityError, InventoryItem.adjust_quantity, test_item.inventory_id, -76)
+        self.assertEqual(InventoryItem.adjust_quantity(test_item.inventory_id, -75)["quantity"], 0)
+        self.assertIsNone(InventoryItem.adjust_quantity(0, 1))
+
+    def test_adjust_quantities(self):
+        """ Add many queued deltas in one transaction """
+        first, second = self._create_test_inventory_items(2)
+        first_id, second_id = first.inventory_id, second.inventory_id
+        outcomes = InventoryItem.adjust_quantities({first_id: [-30, -20, 5], second_id: [-60, -60, 10], 0: [1]})
+        self.assertEqual(outcomes[first_id], [{"inventory_id": first_id, "quantity": 55, "version": 2}] * 3)
+        # the sum overdraws the stock, so the deltas go one by one and only the second is refused
+        self.assertEqual(outcomes[second_id][0], {"inventory_id": second_id, "quantity": 50, "version": 3})
+        self.assertIsInstance(outcomes[second_id][1], InsufficientQuantityError)
+        self.assertEqual(outcomes[second_id][2], outcomes[second_id][0])
+        self.assertEqual(outcomes[0], [None])
+        self.assertEqual(InventoryItem.find(first_id).quantity, 55)
+        self.assertEqual(InventoryItem.find(second_id).quantity, 50)
+        self.assertEqual(SupplierSummary.all()[0].total_quantity, 105)
+
     def test_delete_a_inventory_item(self):
         """ Delete an inventory item """
         test_item = self._create_test_inventory_items(1)[0]
@@ -216,6 +380,18 @@ class TestInventoryItem(unittest.TestCase):
         test_item.delete()
         self.assertEqual(len(InventoryItem.all()), 0)
 
+    def test_delete_a_changed_inventory_item(self):
+        """ Delete an inventory item changed since it was read, and one already gone """
+        test_item = self._create_test_inventory_items(1)[0]
+        test_item = InventoryItem.find(test_item.inventory_id)
+        # another writer commits a change after we read the item
+        InventoryItem.adjust_quantity(test_item.inventory_id, -1)
+        test_item.delete()
+        self.assertEqual(len(InventoryItem.all()), 0)
+        self.assertEqual(SupplierSummary.all(), [])
+        test_item.delete()
+        self.assertEqual(InventoryChange.latest_sequence(), 3)
+
     def test_serialize_a_inventory_item(self):
         """ Test serialization of an inventory item """
         test_item = self._create_test_inventory_items(1)[0]
@@ -266,6 +442,218 @@ class TestInventoryItem(unittest.TestCase):
         inventory_item = InventoryItem()
         self.assertRaises(DataValidationError, inventory_item.deserialize, data)
 
+    def test_create_missing_columns(self):
+        """ Add columns that are missing from an existing table """
+        test_item = self._create_test_inventory_items(1)[0]
+        db.session.remove()
+        columns = ", ".join(
+            column.name for column in InventoryItem.__table__.columns if column.name != "updated_at"
+        )
+        db.engine.execute("CREATE TABLE old_item AS SELECT {} FROM inventory_item".format(columns))
+        db.engine.execute("DROP TABLE inventory_item")
+        db.engine.execute("ALTER TABLE old_item RENAME TO inventory_item")
+        InventoryItem.create_missing_columns()
+        found_item = InventoryItem.find(test_item.inventory_id)
+        self.assertIsNotNone(found_item.updated_at)
+
+    def test_find_restock(self):
+        """ Find inventory items at or below their restock threshold """
+        inventory_items = [
+            _create_test_inventory_item(
+                product_id=123, product_name="test product", quantity=10, restock_threshold=50,
+                supplier_name="test supplier2", supplier_id=125, unit_price=12.50, supplier_status="enabled"),
+            _create_test_inventory_item(
+                product_id=124, product_name="test product2", quantity=50, restock_threshold=50,
+                supplier_name="test supplier1", supplier_id=123, unit_price=12.50, supplier_status="enabled"),
+            _create_test_inventory_item(
+                product_id=125, product_name="test product3", quantity=51, restock_threshold=50,
+                supplier_name="test supplier1", supplier_id=123, unit_price=12.50, supplier_status="enabled"),
+            _create_test_inventory_item(
+                product_id=127, product_name="test product4", quantity=0, restock_threshold=None,
+                supplier_name="test supplier1", supplier_id=123, unit_price=12.50, supplier_status="disabled")]
+        for inventory_item in inventory_items:
+            inventory_item.create()
+        rows = InventoryItem.find_restock([])
+        self.assertEqual([row["product_id"] for row in rows], [124, 123])
+        self.assertEqual(InventoryItem.serialize_row(rows[1]), inventory_items[0].serialize())
+        rows = InventoryItem.find_restock([("supplier_id", "eq", 125)])
+        self.assertEqual([row["product_id"] for row in rows], [123])
+
+    def test_supplier_summary(self):
+        """ Keep the supplier summary equal to the live totals on every write """
+        items = self._create_test_inventory_items(2)
+        InventoryItem.bulk_create([_create_test_inventory_item(
+            product_id=124, product_name="test product2", quantity=10, restock_threshold=5,
+            supplier_name="test supplier2", supplier_id=125, unit_price=2.0, supplier_status="disabled")], 100)
+        summaries = [summary.serialize() for summary in SupplierSummary.all()]
+        self.assertEqual(summaries, InventoryItem.supplier_totals())
+        self.assertEqual(summaries[0], {
+            "supplier_id": 123, "item_count": 2, "enabled_count": 2, "total_quantity": 200, "stock_value": 2500.0
+        })
+
+        items[0].quantity = 50
+        items[0].supplier_id = 125
+        items[0].save()
+        InventoryItem.adjust_quantity(items[1].inventory_id, -20)
+        InventoryItem.toggle_supplier_status(125)
+        items[1].delete()
+        summaries = [summary.serialize() for summary in SupplierSummary.all()]
+        self.assertEqual(summaries, InventoryItem.supplier_totals())
+        self.assertEqual(summaries, [{
+            "supplier_id": 125, "item_count": 2, "enabled_count": 1, "total_quantity": 60, "stock_value": 645.0
+        }])
+
+    def test_change_feed(self):
+        """ Append a change record in the transaction of every write """
+        items = self._create_test_inventory_items(2)
+        new_ids = InventoryItem.bulk_create([_create_test_inventory_item(
+            product_id=124, product_name="test product2", quantity=10, restock_threshold=5,
+            supplier_name="test supplier2", supplier_id=125, unit_price=2.0, supplier_status="disabled")], 100)
+        InventoryItem.load([_create_test_inventory_item(
+            product_id=126, product_name="test product3", quantity=7, restock_threshold=5,
+            supplier_name="test supplier3", supplier_id=126, unit_price=3.0, supplier_status="enabled")])
+        items[0].quantity = 50
+        items[0].save()
+        InventoryItem.adjust_quantity(items[1].inventory_id, -20)
+        InventoryItem.adjust_quantities({items[1].inventory_id: [-5, -5]})
+        InventoryItem.toggle_supplier_status(125)
+        items[1].delete()
+        InventoryItem.delete_by_filters([("supplier_id", "eq", 126)])
+
+        changes = [InventoryChange.serialize_row(row) for row in InventoryChange.since(0, 100)]
+        self.assertEqual([change["sequence"] for change in changes], list(range(1, 11)))
+        self.assertEqual(
+            [(change["operation"], change["inventory_id"]) for change in changes],
+            [("create", items[0].inventory_id), ("create", items[1].inventory_id), ("create", new_ids[0]),
+             ("create", new_ids[0] + 1), ("update", items[0].inventory_id), ("update", items[1].inventory_id),
+             ("update", items[1].inventory_id), ("update", new_ids[0]), ("delete", items[1].inventory_id),
+             ("delete", new_ids[0] + 1)]
+        )
+        # each change carries the item as it was committed
+        self.assertEqual(changes[2]["item"]["supplier_status"], "disabled")
+        self.assertEqual(changes[3]["item"]["product_name"], "test product3")
+        self.assertEqual(changes[4]["item"], InventoryItem.find(items[0].inventory_id).serialize())
+        self.assertEqual(changes[6]["item"]["quantity"], 70)
+        self.assertEqual(changes[7]["item"]["supplier_status"], "enabled")
+        self.assertIsNone(changes[8]["item"])
+        self.assertEqual(len(InventoryChange.since(8, 100)), 2)
+        self.assertEqual(InventoryChange.latest_sequence(), 10)
+
+    def test_change_not_recorded_on_rollback(self):
+        """ Leave the outbox alone when a write fails """
+        item = self._create_test_inventory_items(1)[0]
+        self.assertRaises(InsufficientQuantityError, InventoryItem.adjust_quantity, item.inventory_id, -101)
+        self.assertEqual(len(InventoryChange.since(0, 100)), 1)
+
+    def test_prune_changes(self):
+        """ Delete old changes without reusing their sequences """
+        self._create_test_inventory_items(3)
+        # the newest change stays as the high water mark
+        self.assertEqual(InventoryChange.prune(datetime.utcnow() + timedelta(seconds=1)), 2)
+        self.assertEqual(InventoryChange.oldest_sequence(), 3)
+        self.assertEqual(InventoryChange.latest_sequence(), 3)
+        self._create_test_inventory_items(1)
+        self.assertEqual(InventoryChange.latest_sequence(), 4)
+        self.assertEqual(InventoryChange.prune(datetime.utcnow() - timedelta(hours=1)), 0)
+
+    def test_toggle_supplier_summary_only_flipped_rows(self):
+        """ Change the enabled count by the rows the toggle flipped, not the summary's item count """
+        self._create_test_inventory_items(2)
+        # an enabled item that is counted but committed after the toggle's UPDATE started
+        SupplierSummary.apply({123: [1, 1, 0, 0.0]})
+        db.session.commit()
+        InventoryItem.toggle_supplier_status(123)
+        summary = SupplierSummary.all()[0]
+        self.assertEqual((summary.item_count, summary.enabled_count), (3, 1))
+
+    def test_rebuild_supplier_summary(self):
+        """ Build the supplier summary for items that predate it """
+        self._create_test_inventory_items(2)
+        SupplierSummary.query.delete()
+        db.session.commit()
+        SupplierSummary.init_summary()
+        self.assertEqual([summary.serialize() for summary in SupplierSummary.all()],
+                         InventoryItem.supplier_totals())
+        self.assertEqual(SupplierSummary.all()[0].item_count, 2)
+
+    def test_deserialize_numeric_strings(self):
+        """ Convert numeric fields sent as strings """
+        data = {
+            "product_id": "123", "product_name": "test product", "quantity": "100", "restock_threshold": "50",
+            "supplier_name": "test supplier", "supplier_id": "123", "unit_price": "12.50", "supplier_status": "enabled"
+        }
+        inventory_item = InventoryItem().deserialize(data)
+        self.assertEqual(inventory_item.quantity, 100)
+        self.assertEqual(inventory_item.unit_price, 12.5)
+        data["quantity"] = "lots"
+        self.assertRaises(DataValidationError, InventoryItem().deserialize, data)
+        for quantity in (12.7, True, "12.7"):
+            data["quantity"] = quantity
+            self.assertRaises(DataValidationError, InventoryItem().deserialize, data)
+        data["quantity"] = 12.0
+        self.assertEqual(InventoryItem().deserialize(data).quantity, 12)
+        for unit_price in ("nan", "inf", float("-inf"), False):
+            data["unit_price"] = unit_price
+            self.assertRaises(DataValidationError, InventoryItem().deserialize, data)
+        data["unit_price"] = "12.50"
+        data["quantity"] = "100"
+        data["product_name"] = None
+        self.assertRaises(DataValidationError, InventoryItem().deserialize, data)
+
+    def test_init_db_twice(self):
+        """ Run init_db again against a database that already has the schema """
+        self._create_test_inventory_items(1)
+        with InventoryItem.schema_lock():
+            db.create_all()
+        InventoryItem.init_db(app)
+        self.assertEqual(len(InventoryItem.all()), 1)
+
+    def test_lookup_indexes(self):
+        """ Index the columns used by the find_by_* lookups """
+        indexes = {
+            index["name"]: index["column_names"]
+            for index in inspect(db.engine).get_indexes(InventoryItem.__tablename__)
+        }
+        self.assertEqual(indexes["ix_inventory_item_product_name"], ["product_name"])
+        self.assertEqual(indexes["ix_inventory_item_supplier_status"], ["supplier_status"])
+        self.assertEqual(indexes["ix_inventory_item_supplier_id_status"], ["supplier_id", "supplier_status"])
+        self.assertEqual(indexes["ix_inventory_item_supplier_name_product"], ["supplier_name", "product_name"])
+
+    def test_create_missing_indexes(self):
+        """ Add indexes that are missing from an existing table """
+        db.engine.execute("DROP INDEX ix_inventory_item_product_name")
+        # left behind by an earlier version
+        db.engine.execute("CREATE INDEX ix_inventory_item_updated_at ON inventory_item (updated_at)")
+        InventoryItem.create_missing_indexes()
+        names = [index["name"] for index in inspect(db.engine).get_indexes(InventoryItem.__tablename__)]
+        self.assertIn("ix_inventory_item_product_name", names)
+        self.assertNotIn("ix_inventory_item_updated_at", names)
+
+    def test_find_serialized_through_cache(self):
+        """ Read an inventory item through the cache and invalidate it on writes """
+        item_cache.init_app(app, backend=MemoryCache())
+        try:
+            test_item = self._create_test_inventory_items(1)[0]
+            inventory_id = test_item.inventory_id
+            data = InventoryItem.find_serialized(inventory_id)
+            self.assertEqual(data, test_item.serialize())
+            self.assertEqual(item_cache.get(inventory_id), data)
+
+            test_item.quantity = 5
+            test_item.save()
+            self.assertIsNone(item_cache.get(inventory_id))
+            self.assertEqual(InventoryItem.find_serialized(inventory_id)["quantity"], 5)
+
+            InventoryItem.toggle_supplier_status(test_item.supplier_id)
+            self.assertIsNone(item_cache.get(inventory_id))
+            self.assertEqual(InventoryItem.find_serialized(inventory_id)["supplier_status"], "disabled")
+
+            test_item.delete()
+            self.assertIsNone(item_cache.get(inventory_id))
+            self.assertIsNone(InventoryItem.find_serialized(inventory_id))
+        finally:
+            item_cache.init_app(app, backend=NullCache())
+
     def test_find_or_404_found(self):
         """ Find or return 404 found """
         test_items = self._create_test_inventory_items(5)
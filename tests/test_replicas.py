@@ -0,0 +1,48 @@
+"""
+Test cases for the Read Replicas
+
+"""
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from service.replicas import ReplicaSet
+
+# A SQLite file in a directory that does not exist, so connecting fails
+BROKEN_URI = "sqlite:////nonexistent/directory/replica.db"
+
+
+######################################################################
+#  R E P L I C A   S E T   T E S T   C A S E S
+######################################################################
+class TestReplicaSet(unittest.TestCase):
+    """ Test Cases for the ReplicaSet """
+
+    def test_round_robin(self):
+        """ Hand out the replicas in turn """
+        first, second = create_engine("sqlite://"), create_engine("sqlite://")
+        replica_set = ReplicaSet([first, second])
+        self.assertEqual([replica_set.pick() for _ in range(3)], [first, second, first])
+
+    def test_skip_broken_replica(self):
+        """ Skip a replica that fails to connect until it is checked again """
+        broken, working = create_engine(BROKEN_URI), create_engine("sqlite://")
+        replica_set = ReplicaSet([broken, working], retry_seconds=60)
+        self.assertIs(replica_set.pick(), broken)
+        self.assertRaises(OperationalError, broken.connect)
+        self.assertFalse(replica_set.healthy(broken))
+        self.assertEqual([replica_set.pick() for _ in range(3)], [working] * 3)
+
+        # once the retry time is over it is checked, and still down
+        with patch("service.replicas.time.monotonic", return_value=10 ** 9):
+            self.assertIs(replica_set.pick(), working)
+        self.assertFalse(replica_set.healthy(broken))
+
+    def test_no_healthy_replica(self):
+        """ Return None when every replica is down """
+        broken = create_engine(BROKEN_URI)
+        replica_set = ReplicaSet([broken])
+        replica_set.mark_down(broken)
+        self.assertIsNone(replica_set.pick())
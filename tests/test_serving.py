@@ -0,0 +1,45 @@
+"""
+Test cases for the Gunicorn serving profile
+
+"""
+import multiprocessing
+import os
+import runpy
+import unittest
+from unittest.mock import patch
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+######################################################################
+#  S E R V I N G   P R O F I L E   T E S T   C A S E S
+######################################################################
+class TestServingProfile(unittest.TestCase):
+    """ Test Cases for gunicorn.conf.py """
+
+    def test_sized_from_cpu_count(self):
+        """ Size the workers from the CPU count """
+        with patch.dict(os.environ, {"PORT": "5000"}):
+            os.environ.pop("WEB_CONCURRENCY", None)
+            config = runpy.run_path(CONFIG_FILE)
+        self.assertEqual(config["workers"], multiprocessing.cpu_count() * 2 + 1)
+        self.assertEqual(config["worker_class"], "gthread")
+        self.assertEqual(config["bind"], "0.0.0.0:5000")
+        self.assertTrue(config["preload_app"])
+
+    def test_sized_from_environment(self):
+        """ Override the workers and threads from the environment """
+        with patch.dict(os.environ, {"WEB_CONCURRENCY": "3", "GUNICORN_THREADS": "8"}):
+            config = runpy.run_path(CONFIG_FILE)
+        self.assertEqual(config["workers"], 3)
+        self.assertEqual(config["threads"], 8)
+
+    def test_metrics_directory(self):
+        """ Give the workers a directory to share their metrics in """
+        with patch.dict(os.environ, {"METRICS_DIR": ""}):
+            runpy.run_path(CONFIG_FILE)
+            self.assertTrue(os.path.isdir(os.environ["METRICS_DIR"]))
+            os.rmdir(os.environ["METRICS_DIR"])
+        with patch.dict(os.environ, {"METRICS_DIR": "/var/run/inventory-metrics"}):
+            runpy.run_path(CONFIG_FILE)
+            self.assertEqual(os.environ["METRICS_DIR"], "/var/run/inventory-metrics")